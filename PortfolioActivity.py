@@ -37,14 +37,18 @@ from sugar3.graphics.toolbarbox import ToolbarButton
 from sugar3.datastore import datastore
 
 from sprites import (Sprites, Sprite)
-from utils import (get_path, lighter_color, svg_str_to_pixbuf, svg_rectangle,
-                   get_pixbuf_from_journal, genblank, get_hardware, rgb,
-                   pixbuf_to_base64, base64_to_pixbuf, get_pixbuf_from_file,
+from utils import (get_path, lighter_color, chrome_pixbuf, BLANK, FRAME,
+                   get_hardware, rgb, pixbuf_to_base64, base64_to_pixbuf,
                    parse_comments, get_tablet_mode)
 
-from exportpdf import save_pdf
+from exportpdf import PDFExporter, PageCache
+from previews import Preview, PixbufCache, FILE, JOURNAL, pixbuf_size
+from prefetch import Prefetcher, DecodePool
+from iconatlas import IconAtlas
+from thumbstore import ThumbnailStore
+from thumbpack import ThumbnailPack, frame_thumbnail
 from toolbar_utils import (radio_factory, button_factory, separator_factory,
-                           combo_factory, label_factory)
+                           combo_factory, label_factory, toggle_factory)
 from arecord import Arecord
 from aplay import aplay
 
@@ -106,6 +110,28 @@ HIDE = 0
 
 OSK_SHIFT = 200
 
+# Bytes of decoded previews and thumbnails to keep in memory (sized so
+# that a 1 GB machine has plenty left for the rest of Sugar)
+PREVIEW_CACHE_BUDGET = 32 * 1024 * 1024
+
+# Bytes of scaled previews and thumbnails to keep on disk between launches
+THUMB_STORE_BUDGET = 64 * 1024 * 1024
+
+# How many slides to decode ahead of time while autoplaying
+AUTOPLAY_PREFETCH = 3
+
+# Wait this long (ms) for a burst of Journal changes to finish
+JOURNAL_CHANGE_DELAY = 500
+
+# Pictures in exported PDFs are embedded as JPEG at this resolution
+PDF_DPI = 150
+PDF_JPEG_QUALITY = 85
+
+# Thumbnails are never made narrower than this; the grid scrolls instead
+THUMB_MIN_WIDTH = 160
+# Rows above and below the screen that also get thumbnail sprites
+THUMB_ROW_MARGIN = 1
+
 
 def _get_screen_dpi():
     xft_dpi = Gtk.Settings.get_default().get_property('gtk-xft-dpi')
@@ -113,6 +139,17 @@ def _get_screen_dpi():
     return dpi
 
 
+def _get_stamp(dsobj):
+    ''' When was a Journal entry last changed? '''
+    if not hasattr(dsobj, 'metadata'):
+        return None
+    return (dsobj.metadata.get('timestamp'), dsobj.metadata.get('mtime'))
+
+
+def _pixbuf_wh(pixbuf):
+    return (pixbuf.get_width(), pixbuf.get_height())
+
+
 class Slide():
 
     ''' A container for a slide '''
@@ -123,7 +160,7 @@ class Slide():
         self.uid = uid
         self.colors = colors
         self.title = title
-        self.preview = preview
+        self.preview = preview  # a Preview, only decoded when needed
         self.preview2 = None  # larger version for fullscreen mode
         self.description = desc
         self.comment = comment  # A list of dictionaries
@@ -131,7 +168,10 @@ class Slide():
         self.dirty = False
         self.fav = True
         self.thumb = None
+        self.thumb_ready = False  # False while the thumb is a placeholder
         self.star = None
+        self.dsobj = None  # The Journal entry, if the slide is ours
+        self.stamp = None  # Journal timestamp when we last read it
 
     def hide(self):
         if self.star is not None:
@@ -140,6 +180,89 @@ class Slide():
             self.thumb.hide()
 
 
+class SlideList():
+
+    ''' The slides in show order, indexed by uid, by sprite and by
+    position so that finding a slide does not mean walking the list '''
+
+    def __init__(self):
+        self._list = []
+        self._by_uid = {}
+        self._by_sprite = {}
+        self._position = {}
+
+    def __len__(self):
+        return len(self._list)
+
+    def __iter__(self):
+        return iter(self._list)
+
+    def __getitem__(self, i):
+        return self._list[i]
+
+    def __contains__(self, slide):
+        return slide in self._position
+
+    def _reindex(self, first=0, last=None):
+        ''' Record the positions of slides first..last '''
+        if last is None:
+            last = len(self._list) - 1
+        for i in range(first, last + 1):
+            self._position[self._list[i]] = i
+
+    def append(self, slide):
+        self._list.append(slide)
+        self._position[slide] = len(self._list) - 1
+        self._by_uid[slide.uid] = slide
+        for spr in [slide.thumb, slide.star]:
+            if spr is not None:
+                self._by_sprite[spr] = slide
+
+    def remove(self, slide):
+        i = self._position.pop(slide)
+        del self._list[i]
+        if self._by_uid.get(slide.uid) is slide:
+            del self._by_uid[slide.uid]
+        for spr in [slide.thumb, slide.star]:
+            self._by_sprite.pop(spr, None)
+        self._reindex(i)
+
+    def index(self, slide):
+        return self._position[slide]
+
+    def swap(self, i, j):
+        ''' Swap the slides at positions i and j '''
+        self._list[i], self._list[j] = self._list[j], self._list[i]
+        self._position[self._list[i]] = i
+        self._position[self._list[j]] = j
+
+    def move(self, i, j):
+        ''' Move the slide at position i to position j, shifting the
+        slides in between '''
+        self._list.insert(j, self._list.pop(i))
+        self._reindex(min(i, j), max(i, j))
+
+    def by_uid(self, uid):
+        return self._by_uid.get(uid)
+
+    def by_sprite(self, spr):
+        return self._by_sprite.get(spr)
+
+    def set_thumb(self, slide, spr):
+        ''' Give a slide a new (or no) thumbnail sprite '''
+        self._by_sprite.pop(slide.thumb, None)
+        slide.thumb = spr
+        if spr is not None:
+            self._by_sprite[spr] = slide
+
+    def set_star(self, slide, spr):
+        ''' Give a slide a new (or no) star sprite '''
+        self._by_sprite.pop(slide.star, None)
+        slide.star = spr
+        if spr is not None:
+            self._by_sprite[spr] = slide
+
+
 class PortfolioActivity(activity.Activity):
 
     ''' Make a slideshow from starred Journal entries. '''
@@ -170,8 +293,25 @@ class PortfolioActivity(activity.Activity):
         self._setup_toolbars()
         self._setup_canvas()
 
-        self._slides = []
+        self._slides = SlideList()
+        self.preview_cache = PixbufCache(PREVIEW_CACHE_BUDGET)
+        self._thumb_store = ThumbnailStore(
+            os.path.join(self.datapath, 'thumbs'), THUMB_STORE_BUDGET)
+        self._thumb_pack = ThumbnailPack(self.datapath)
+        self._prefetcher = Prefetcher(self._prefetch_ready_cb)
+        self._decoder = DecodePool(self._decoded_cb)
+        self._journal_changes = {}  # object_id: True if deleted
+        self._journal_change_id = None
+        self._following_journal = False
+        self._thumb_fill = set()  # Thumbnails asked of the decoder
+        self._thumb_slides = []  # The active slides, in grid order
+        self._thumb_grid = None  # x offset, columns, tile width and height
+        self._thumb_scroll = 0
+        self._thumb_bound = set()  # Slides with thumbnail sprites
+        self._thumb_pool = []  # Spare (thumb, star) sprites
         self._current_slide = 0
+        self._exporter = None
+        self.page_cache = PageCache()  # PDF pages from the last export
 
         self._thumbnail_mode = False
         self._find_starred()
@@ -191,6 +331,13 @@ class PortfolioActivity(activity.Activity):
         self._autoplay_id = None
 
     def close(self, **kwargs):
+        _logger.debug('preview cache: %r' % (self.preview_cache.stats()))
+        self._stop_following_journal()
+        self._prefetcher.stop()
+        self._decoder.stop()
+        if self._exporter is not None:
+            self._exporter.cancel()
+        self._thumb_pack.flush(keep=[slide.uid for slide in self._slides])
         aplay.close()
         activity.Activity.close(self, **kwargs)
 
@@ -270,11 +417,13 @@ class PortfolioActivity(activity.Activity):
         self._canvas.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
         self._canvas.add_events(Gdk.EventMask.BUTTON_RELEASE_MASK)
         self._canvas.add_events(Gdk.EventMask.KEY_PRESS_MASK)
+        self._canvas.add_events(Gdk.EventMask.SCROLL_MASK)
         self._canvas.connect('draw', self._draw_cb)
         self._canvas.connect('button-press-event', self._button_press_cb)
         self._canvas.connect('button-release-event', self._button_release_cb)
         self._canvas.connect('motion-notify-event', self._mouse_move_cb)
         self._canvas.connect('key-press-event', self._keypress_cb)
+        self._canvas.connect('scroll-event', self._scroll_cb)
         Gdk.Screen.get_default().connect('size-changed', self._configure_cb)
 
         self._canvas.grab_focus()
@@ -305,6 +454,10 @@ class PortfolioActivity(activity.Activity):
         self._canvas.show()
         self._set_xy_wh()
 
+        # Slide-view images scaled for the old size are no use now
+        self._prefetcher.cancel()
+        self.preview_cache.invalidate_kind('slide')
+
         self._configured_sprites()  # Some sprites are sized to screen
         self._my_canvas.set_layer(BOTTOM)
         self._clear_screen()
@@ -335,30 +488,27 @@ class PortfolioActivity(activity.Activity):
         if self._nobjects == 0:
             star_size = GRID_CELL_SIZE
         else:
-            star_size = int(150. / int(ceil(sqrt(self._nobjects))))
-        self._fav_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(activity.get_bundle_path(), 'icons',
-                         'favorite-on.svg'), star_size, star_size)
-        self._unfav_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(activity.get_bundle_path(), 'icons',
-                         'favorite-off.svg'), star_size, star_size)
-
-        self.record_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(activity.get_bundle_path(), 'icons',
-                         'media-audio.svg'), GRID_CELL_SIZE, GRID_CELL_SIZE)
-        self.recording_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(
-                activity.get_bundle_path(),
-                'icons',
-                'media-audio-recording.svg'),
-            GRID_CELL_SIZE,
-            GRID_CELL_SIZE)
-        self.playback_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(activity.get_bundle_path(), 'icons',
-                         'speaker-100.svg'), GRID_CELL_SIZE, GRID_CELL_SIZE)
-        self.playing_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(activity.get_bundle_path(), 'icons',
-                         'speaker-0.svg'), GRID_CELL_SIZE, GRID_CELL_SIZE)
+            # The stars go on the thumbnails, so size them to the tiles
+            tile_width = self._thumb_columns(self._nobjects)[1]
+            star_size = int(150. * tile_width / self._width)
+        icons = os.path.join(activity.get_bundle_path(), 'icons')
+        stars = IconAtlas(self.datapath, icons, star_size, star_size,
+                          names=['favorite-on.svg', 'favorite-off.svg'])
+        self._fav_pixbuf = stars.get('favorite-on.svg')
+        self._unfav_pixbuf = stars.get('favorite-off.svg')
+
+        buttons = IconAtlas(self.datapath, icons,
+                            GRID_CELL_SIZE, GRID_CELL_SIZE,
+                            names=['media-audio.svg',
+                                   'media-audio-recording.svg',
+                                   'speaker-100.svg', 'speaker-0.svg',
+                                   'go-previous.svg', 'go-next.svg',
+                                   'go-previous-inactive.svg',
+                                   'go-next-inactive.svg'])
+        self.record_pixbuf = buttons.get('media-audio.svg')
+        self.recording_pixbuf = buttons.get('media-audio-recording.svg')
+        self.playback_pixbuf = buttons.get('speaker-100.svg')
+        self.playing_pixbuf = buttons.get('speaker-0.svg')
 
         self._record_button = Sprite(self._sprites, 0, 0, self.record_pixbuf)
         self._record_button.set_layer(DRAG)
@@ -369,26 +519,10 @@ class PortfolioActivity(activity.Activity):
         self._playback_button.type = 'noplay'
         self._playback_button.hide()
 
-        self.prev_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(activity.get_bundle_path(), 'icons',
-                         'go-previous.svg'), GRID_CELL_SIZE, GRID_CELL_SIZE)
-        self.next_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(activity.get_bundle_path(), 'icons',
-                         'go-next.svg'), GRID_CELL_SIZE, GRID_CELL_SIZE)
-        self.prev_off_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(
-                activity.get_bundle_path(),
-                'icons',
-                'go-previous-inactive.svg'),
-            GRID_CELL_SIZE,
-            GRID_CELL_SIZE)
-        self.next_off_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-            os.path.join(
-                activity.get_bundle_path(),
-                'icons',
-                'go-next-inactive.svg'),
-            GRID_CELL_SIZE,
-            GRID_CELL_SIZE)
+        self.prev_pixbuf = buttons.get('go-previous.svg')
+        self.next_pixbuf = buttons.get('go-next.svg')
+        self.prev_off_pixbuf = buttons.get('go-previous-inactive.svg')
+        self.next_off_pixbuf = buttons.get('go-next-inactive.svg')
 
         self._prev = Sprite(self._sprites, 0, 0, self.prev_off_pixbuf)
         self._prev.set_layer(DRAG)
@@ -398,20 +532,18 @@ class PortfolioActivity(activity.Activity):
         self._next.set_layer(DRAG)
         self._next.type = 'next'
 
-        self._help = Sprite(
-            self._sprites, 0, 0, GdkPixbuf.Pixbuf.new_from_file_at_size(
-                os.path.join(
-                    activity.get_bundle_path(), 'help.png'), int(
-                    self._preview_wh[0]), int(
-                    self._preview_wh[1])))
+        help_atlas = IconAtlas(self.datapath, activity.get_bundle_path(),
+                               self._preview_wh[0], self._preview_wh[1],
+                               names=['help.png'])
+        self._help = Sprite(self._sprites, 0, 0, help_atlas.get('help.png'))
         self._help.hide()
 
         self._preview = Sprite(self._sprites,
                                0, 0,
-                               svg_str_to_pixbuf(genblank(
-                                   int(self._preview_wh[0]),
-                                   int(self._preview_wh[1]),
-                                   self._colors)))
+                               chrome_pixbuf(BLANK,
+                                             self._preview_wh[0],
+                                             self._preview_wh[1],
+                                             self._colors))
 
         self._configured_sprites()  # Some sprites are sized to screen
 
@@ -425,7 +557,9 @@ class PortfolioActivity(activity.Activity):
 
     def _configured_sprites(self):
         ''' Some sprites are sized or positioned based on screen
-        configuration '''
+        configuration. They are made the first time through; after that
+        they are resized and moved in place, with a single redraw. '''
+        self._sprites.defer_inval()
 
         self._preview.move((int(self._preview_xy[0]),
                             int(self._preview_xy[1])))
@@ -438,60 +572,66 @@ class PortfolioActivity(activity.Activity):
         self._prev.move((0, int((self._height - GRID_CELL_SIZE) / 2)))
         self._next.move((self._width - GRID_CELL_SIZE,
                          int((self._height - GRID_CELL_SIZE) / 2)))
-        self._title = Sprite(
-            self._sprites, int(
-                self._title_xy[0]), int(
-                self._title_xy[1]), svg_str_to_pixbuf(
-                genblank(
-                    self._title_wh[0], self._title_wh[1], self._colors)))
-        self._title.set_label_attributes(self.title_size, rescale=False)
-        self._title.type = 'title'
-
-        self._description = Sprite(self._sprites,
-                                   int(self._desc_xy[0]),
-                                   int(self._desc_xy[1]),
-                                   svg_str_to_pixbuf(
-                                       genblank(int(self._desc_wh[0]),
-                                                int(self._desc_wh[1]),
-                                                self._colors)))
-        self._description.set_label_attributes(self.desc_size,
-                                               horiz_align="left",
-                                               rescale=False, vert_align="top")
-        m = int(self.desc_size / 2)
-        self._description.set_margins(l=m, t=m, r=m, b=m)
-        self._description.type = 'description'
-
-        self._comment = Sprite(self._sprites,
-                               int(self._comment_xy[0]),
-                               int(self._comment_xy[1]),
-                               svg_str_to_pixbuf(
-                                   genblank(int(self._comment_wh[0]),
-                                            int(self._comment_wh[1]),
-                                            self._colors)))
-        self._comment.set_label_attributes(int(self.desc_size * 0.67),
-                                           vert_align="top",
-                                           horiz_align="left",
-                                           rescale=False)
-        self._comment.set_margins(l=m, t=m, r=m, b=m)
-        self._new_comment = Sprite(self._sprites,
-                                   int(self._new_comment_xy[0]),
-                                   int(self._new_comment_xy[1]),
-                                   svg_str_to_pixbuf(
-                                       genblank(int(self._new_comment_wh[0]),
-                                                int(self._new_comment_wh[1]),
-                                                self._colors)))
-        self._new_comment.set_label_attributes(self.desc_size,
+
+        title = chrome_pixbuf(BLANK, self._title_wh[0], self._title_wh[1],
+                              self._colors)
+        description = chrome_pixbuf(BLANK, self._desc_wh[0],
+                                    self._desc_wh[1], self._colors)
+        comment = chrome_pixbuf(BLANK, self._comment_wh[0],
+                                self._comment_wh[1], self._colors)
+        new_comment = chrome_pixbuf(BLANK, self._new_comment_wh[0],
+                                    self._new_comment_wh[1], self._colors)
+        background = chrome_pixbuf(BLANK, self._width, self._height,
+                                   (self._colors[0], self._colors[0]))
+
+        if not hasattr(self, '_my_canvas'):
+            self._title = Sprite(self._sprites, 0, 0, title)
+            self._title.set_label_attributes(self.title_size, rescale=False)
+            self._title.type = 'title'
+
+            m = int(self.desc_size / 2)
+            self._description = Sprite(self._sprites, 0, 0, description)
+            self._description.set_label_attributes(self.desc_size,
+                                                   horiz_align="left",
+                                                   rescale=False,
+                                                   vert_align="top")
+            self._description.set_margins(l=m, t=m, r=m, b=m)
+            self._description.type = 'description'
+
+            self._comment = Sprite(self._sprites, 0, 0, comment)
+            self._comment.set_label_attributes(int(self.desc_size * 0.67),
+                                               vert_align="top",
                                                horiz_align="left",
-                                               vert_align="top", rescale=False)
-        self._new_comment.type = 'comment'
-        self._new_comment.set_label(_('Enter comments here.'))
-
-        self._my_canvas = Sprite(
-            self._sprites, 0, 0, svg_str_to_pixbuf(genblank(
-                self._width, self._height, (self._colors[0],
-                                            self._colors[0]))))
-        self._my_canvas.set_layer(BOTTOM)
-        self._my_canvas.type = 'background'
+                                               rescale=False)
+            self._comment.set_margins(l=m, t=m, r=m, b=m)
+
+            self._new_comment = Sprite(self._sprites, 0, 0, new_comment)
+            self._new_comment.set_label_attributes(self.desc_size,
+                                                   horiz_align="left",
+                                                   vert_align="top",
+                                                   rescale=False)
+            self._new_comment.type = 'comment'
+            self._new_comment.set_label(_('Enter comments here.'))
+
+            self._my_canvas = Sprite(self._sprites, 0, 0, background)
+            self._my_canvas.set_layer(BOTTOM)
+            self._my_canvas.type = 'background'
+        else:
+            self._title.set_shape(title)
+            self._description.set_shape(description)
+            self._comment.set_shape(comment)
+            self._new_comment.set_shape(new_comment)
+            self._my_canvas.set_shape(background)
+
+        self._title.move((int(self._title_xy[0]), int(self._title_xy[1])))
+        self._description.move((int(self._desc_xy[0]),
+                                int(self._desc_xy[1])))
+        self._comment.move((int(self._comment_xy[0]),
+                            int(self._comment_xy[1])))
+        self._new_comment.move((int(self._new_comment_xy[0]),
+                                int(self._new_comment_xy[1])))
+
+        self._sprites.flush_inval()
 
     def _setup_toolbars(self):
         ''' Setup the toolbars. '''
@@ -548,6 +688,11 @@ class PortfolioActivity(activity.Activity):
                        self._rescan_cb,
                        tooltip=_('Refresh'))
 
+        toggle_factory('media-playlist-repeat',
+                       adjust_toolbar,
+                       self._follow_journal_cb,
+                       tooltip=_('Follow Journal changes'))
+
         separator_factory(self.toolbar)
 
         self._slide_button = radio_factory('slide-view',
@@ -584,84 +729,176 @@ class PortfolioActivity(activity.Activity):
     def _thumb_to_slide(self, spr):
         if spr is None:
             return None
-        for slide in self._slides:
-            if slide.thumb == spr:
-                return slide
+        slide = self._slides.by_sprite(spr)
+        if slide is not None and slide.thumb == spr:
+            return slide
         return None
 
     def _star_to_slide(self, spr):
         if spr is None:
             return None
-        for slide in self._slides:
-            if slide.star == spr:
-                return slide
+        slide = self._slides.by_sprite(spr)
+        if slide is not None and slide.star == spr:
+            return slide
         return None
 
     def _uid_to_slide(self, uid):
-        for slide in self._slides:
-            if slide.uid == uid:
-                return slide
-        return None
-
-    def _make_star(self, slide):
-        slide.star = Sprite(self._sprites, 0, 0, self._fav_pixbuf)
-        slide.star.type = 'star'
-        slide.star.set_layer(STAR)
-        slide.fav = True
+        return self._slides.by_uid(uid)
 
     def _find_starred(self):
-        ''' Find all the _stars in the Journal. '''
-        for slide in self._slides:
-            slide.active = False
-        self.dsobjects, self._nobjects = datastore.find({'keep': '1'})
-        for dsobj in self.dsobjects:
+        ''' Find all the _stars in the Journal. After the first scan,
+        only entries that are new or have changed are read again. '''
+        first_scan = len(self._slides) == 0
+        if first_scan:
+            dsobjects, self._nobjects = datastore.find({'keep': '1'})
+        else:
+            # Just enough metadata to tell what has changed
+            dsobjects, self._nobjects = datastore.find(
+                {'keep': '1'}, properties=['uid', 'timestamp', 'mtime'])
+
+        found = set()
+        updated = []  # Slides made or changed by this scan
+        for dsobj in dsobjects:
+            found.add(dsobj.object_id)
             slide = self._uid_to_slide(dsobj.object_id)
-            owner = self._buddies[0]
-            title = ''
-            desc = ''
-            comment = []
-            preview = None
-            if hasattr(dsobj, 'metadata'):
-                if 'title' in dsobj.metadata:
-                    title = dsobj.metadata['title']
-                if 'description' in dsobj.metadata:
-                    desc = dsobj.metadata['description']
-                if 'comments' in dsobj.metadata:
-                    try:
-                        comment = json.loads(dsobj.metadata['comments'])
-                        _logger.debug(comment)
-                    except:
-                        comment = []
-                if 'mime_type' in dsobj.metadata and \
-                   dsobj.metadata['mime_type'][0:5] == 'image':
-                    preview = get_pixbuf_from_file(
-                        dsobj.file_path,
-                        int(PREVIEW[self._orientation][2] * self._scale),
-                        int(PREVIEW[self._orientation][3] * self._scale))
-                elif 'preview' in dsobj.metadata:
-                    preview = get_pixbuf_from_journal(dsobj, 300, 225)
-            else:
-                _logger.debug('dsobj has no metadata')
-
-            if slide is None:
-                self._slides.append(Slide(owner,
-                                          dsobj.object_id,
-                                          self._colors,
-                                          title,
-                                          preview,
-                                          desc,
-                                          comment))
-            else:
-                slide.title = title
-                slide.preview = preview
-                slide.description = desc
-                slide.comment = comment
+            if slide is not None and slide.dsobj is not None and \
+               slide.stamp == _get_stamp(dsobj):
+                # Unchanged, so nothing to decode
                 slide.active = True
                 slide.fav = True
-                if slide.star is not None:
-                    slide.star.hide()
-                if slide.thumb is not None:
-                    slide.thumb.hide()
+                slide.hide()
+            elif first_scan:
+                updated.append(self._update_slide(dsobj, None))
+            else:
+                if slide is not None:
+                    _logger.debug('%s has changed' % (dsobj.object_id))
+                dsobj = datastore.get(dsobj.object_id)
+                updated.append(self._update_slide(dsobj, slide))
+
+        # Drop the entries that are no longer starred
+        for slide in self._slides[:]:
+            if slide.dsobj is not None and slide.uid not in found:
+                self._drop_slide(slide)
+        self._warm_previews(updated)
+
+    def _warm_previews(self, slides):
+        ''' Decode the image files of new or changed slides that have no
+        copy saved on disk yet, in parallel and in Journal order, so
+        that they are ready (or at least quick to load) by the time they
+        are shown. '''
+        for slide in slides:
+            preview = slide.preview
+            if preview is None or preview.kind != FILE or \
+               preview.key in self.preview_cache or preview.stored():
+                continue
+            self._decoder.request(preview.key, preview)
+
+    def _decoded_cb(self, key, preview, pixbuf, scaled):
+        ''' The decoder has finished a job (called on the main loop). '''
+        slide = self._uid_to_slide(preview.uid)
+        if slide is None or slide.preview is not preview:
+            # The slide has changed since we asked for it.
+            self._finish_thumb_fill(key)
+            return
+        if self._need_file(preview, pixbuf):
+            if key[1] == 'thumb':
+                self._decoder.request(key, preview, key[2], key[3],
+                                      urgent=True)
+            else:
+                self._decoder.request(key, preview)
+            return
+        if key[1] == 'thumb':
+            if slide.thumb is not None and not slide.thumb_ready and \
+               scaled is not None and \
+               tuple(slide.thumb.get_dimensions()) == key[2:]:
+                slide.thumb.set_shape(self._add_thumb_image(slide, scaled))
+                slide.thumb_ready = True
+            self._finish_thumb_fill(key)
+        elif pixbuf is not None and key not in self.preview_cache and \
+                self.preview_cache.size + pixbuf_size(pixbuf) <= \
+                self.preview_cache.budget:
+            # Keep what fits in memory, without pushing anything out
+            self.preview_cache.put(key, pixbuf)
+
+    def _finish_thumb_fill(self, key):
+        ''' A thumbnail job is over; save the pack once they all are. '''
+        if key[1] != 'thumb':
+            return
+        self._thumb_fill.discard(key)
+        if len(self._thumb_fill) == 0:
+            self._thumb_pack.flush()
+
+    def _need_file(self, preview, pixbuf):
+        ''' If the copy saved by an earlier launch could not be read,
+        look up the image file so that it can be decoded instead.
+        Return True if the preview should be asked for again. '''
+        if pixbuf is not None or preview.kind != FILE or preview.has_file():
+            return False
+        preview.prepare()
+        return preview.has_file()
+
+    def _drop_slide(self, slide):
+        ''' Forget a slide whose Journal entry is no longer starred. '''
+        _logger.debug('%s is no longer starred' % (slide.uid))
+        self._release_thumb(slide)
+        self.preview_cache.invalidate(slide.uid)
+        self._slides.remove(slide)
+
+    def _update_slide(self, dsobj, slide):
+        ''' Create (or update) a slide from a Journal entry; return it. '''
+        owner = self._buddies[0]
+        title = ''
+        desc = ''
+        comment = []
+        preview = None
+        if hasattr(dsobj, 'metadata'):
+            if 'title' in dsobj.metadata:
+                title = dsobj.metadata['title']
+            if 'description' in dsobj.metadata:
+                desc = dsobj.metadata['description']
+            if 'comments' in dsobj.metadata:
+                try:
+                    comment = json.loads(dsobj.metadata['comments'])
+                    _logger.debug(comment)
+                except:
+                    comment = []
+            if 'mime_type' in dsobj.metadata and \
+               dsobj.metadata['mime_type'][0:5] == 'image':
+                preview = Preview(
+                    dsobj.object_id,
+                    int(PREVIEW[self._orientation][2] * self._scale),
+                    int(PREVIEW[self._orientation][3] * self._scale),
+                    dsobj=dsobj, kind=FILE, cache=self.preview_cache,
+                    store=self._thumb_store, stamp=_get_stamp(dsobj))
+            elif 'preview' in dsobj.metadata:
+                preview = Preview(dsobj.object_id, 300, 225,
+                                  dsobj=dsobj, kind=JOURNAL,
+                                  cache=self.preview_cache)
+        else:
+            _logger.debug('dsobj has no metadata')
+
+        if slide is None:
+            slide = Slide(owner,
+                          dsobj.object_id,
+                          self._colors,
+                          title,
+                          preview,
+                          desc,
+                          comment)
+            self._slides.append(slide)
+        else:
+            slide.title = title
+            self.preview_cache.invalidate(slide.uid)
+            slide.preview = preview
+            slide.description = desc
+            slide.comment = comment
+            slide.active = True
+            slide.fav = True
+            # The old thumbnail is out of date
+            self._release_thumb(slide)
+        slide.dsobj = dsobj
+        slide.stamp = _get_stamp(dsobj)
+        return slide
 
     def _rescan_cb(self, button=None):
         ''' Rescan the Journal for changes in starred items. '''
@@ -679,6 +916,102 @@ class PortfolioActivity(activity.Activity):
         else:
             self._show_slide()
 
+    def _follow_journal_cb(self, button):
+        ''' Listen for changes to the Journal instead of waiting for
+        the Refresh button. '''
+        if button.get_active():
+            datastore.created.connect(self._journal_created_cb)
+            datastore.updated.connect(self._journal_updated_cb)
+            datastore.deleted.connect(self._journal_deleted_cb)
+            self._following_journal = True
+            # Catch up with anything we missed while not listening
+            self._rescan_cb()
+        else:
+            self._stop_following_journal()
+
+    def _stop_following_journal(self):
+        ''' Stop listening for changes to the Journal. '''
+        if not self._following_journal:
+            return
+        datastore.created.disconnect(self._journal_created_cb)
+        datastore.updated.disconnect(self._journal_updated_cb)
+        datastore.deleted.disconnect(self._journal_deleted_cb)
+        self._following_journal = False
+        if self._journal_change_id is not None:
+            GLib.source_remove(self._journal_change_id)
+            self._journal_change_id = None
+        self._journal_changes = {}
+
+    def _journal_created_cb(self, sender, object_id=None, **kwargs):
+        self._queue_journal_change(object_id, False)
+
+    def _journal_updated_cb(self, sender, object_id=None, **kwargs):
+        self._queue_journal_change(object_id, False)
+
+    def _journal_deleted_cb(self, sender, object_id=None, **kwargs):
+        self._queue_journal_change(object_id, True)
+
+    def _queue_journal_change(self, object_id, deleted):
+        ''' Collect a burst of changes (e.g., starring many entries at
+        once) into a single update. The timer is not restarted, so a
+        steady stream of changes is still applied every
+        JOURNAL_CHANGE_DELAY ms. '''
+        if object_id is None:
+            return
+        if self.initiating is not None and not self.initiating:
+            return  # Joiners show the sharer's slides.
+        self._journal_changes[object_id] = deleted
+        if self._journal_change_id is None:
+            self._journal_change_id = GLib.timeout_add(
+                JOURNAL_CHANGE_DELAY, self._apply_journal_changes)
+
+    def _apply_journal_changes(self):
+        ''' Apply the queued Journal changes to the slides. '''
+        self._journal_change_id = None
+        changes = self._journal_changes
+        self._journal_changes = {}
+        changed = []
+        updated = []
+        dropped = []
+        for object_id, deleted in changes.items():
+            slide = self._uid_to_slide(object_id)
+            dsobj = None
+            if not deleted:
+                try:
+                    dsobj = datastore.get(object_id)
+                except Exception as e:
+                    _logger.debug('could not get %s: %s' % (object_id, e))
+            if dsobj is not None and dsobj.metadata.get('keep') == '1':
+                if slide is None or slide.stamp != _get_stamp(dsobj):
+                    updated.append(self._update_slide(dsobj, slide))
+                    changed.append(object_id)
+            elif slide is not None and slide.dsobj is not None:
+                self._drop_slide(slide)
+                dropped.append(object_id)
+        if len(changed) == 0 and len(dropped) == 0:
+            return False
+        self._warm_previews(updated)
+
+        self._nobjects = len([slide for slide in self._slides
+                              if slide.dsobj is not None])
+        if self.initiating:
+            for object_id in changed:
+                slide = self._uid_to_slide(object_id)
+                GLib.idle_add(self._send_event, 's', {"data": (
+                    str(self._dump(slide)))})
+            for object_id in dropped:
+                self._send_star(object_id, False)
+
+        # Update the screen once for the whole batch
+        self._help.hide()
+        if self.i > len(self._slides) - 1:
+            self.i = max(0, len(self._slides) - 1)
+        if self._thumbnail_mode:
+            self._show_thumbs()
+        else:
+            self._show_slide()
+        return False
+
     def _first_cb(self, button=None):
         self.i = 0
         self._show_slide(direction=-1)
@@ -706,6 +1039,7 @@ class PortfolioActivity(activity.Activity):
         else:
             if self._thumbnail_mode:
                 self._thumbnail_mode = False
+                self._drop_thumbs()
                 self.i = self._current_slide
             if self._first_time:
                 self.i -= 1
@@ -737,12 +1071,45 @@ class PortfolioActivity(activity.Activity):
             nick = self._buddies[-1]
         else:
             nick = profile.get_nick_name()
+        if self._exporter is not None:
+            # A second click cancels the export
+            _logger.debug('cancelling PDF export')
+            self._exporter.cancel()
+            return
+
         _logger.debug('saving to PDF...')
         if 'description' in self.metadata:
-            tmp_file = save_pdf(self, nick,
-                                description=self.metadata['description'])
+            self._exporter = PDFExporter(
+                self, nick, self._slides,
+                description=self.metadata['description'],
+                progress_cb=self._pdf_progress_cb,
+                done_cb=self._pdf_done_cb, dpi=PDF_DPI,
+                jpeg_quality=PDF_JPEG_QUALITY)
         else:
-            tmp_file = save_pdf(self, profile.get_nick_name())
+            self._exporter = PDFExporter(
+                self, profile.get_nick_name(), self._slides,
+                progress_cb=self._pdf_progress_cb,
+                done_cb=self._pdf_done_cb, dpi=PDF_DPI,
+                jpeg_quality=PDF_JPEG_QUALITY)
+        self._pdf_nick = nick
+        self.busy()
+        self._save_pdf.set_tooltip(_('Saving as PDF (click to cancel)'))
+        self._exporter.start()
+
+    def _pdf_progress_cb(self, done, total):
+        self._save_pdf.set_tooltip(
+            _('Saving page %(done)d of %(total)d (click to cancel)') %
+            {'done': done, 'total': total})
+        return False
+
+    def _pdf_done_cb(self, tmp_file):
+        ''' The PDF has been written (or the export was cancelled). '''
+        self._exporter = None
+        self.unbusy()
+        self._save_pdf.set_tooltip(_('Save as PDF'))
+        if tmp_file is None:
+            return False
+        nick = self._pdf_nick
 
         dsobject = datastore.create()
         dsobject.metadata['title'] = '%s %s' % (nick, _('Portfolio'))
@@ -752,7 +1119,7 @@ class PortfolioActivity(activity.Activity):
         dsobject.metadata['activity'] = 'org.laptop.sugar3.ReadActivity'
         datastore.write(dsobject)
         dsobject.destroy()
-        return
+        return False
 
     def _clear_screen(self):
         ''' Clear the screen to the darker of the two XO colors. '''
@@ -817,13 +1184,10 @@ class PortfolioActivity(activity.Activity):
         self._prev.set_layer(DRAG)
         self._next.set_layer(DRAG)
 
-        pixbuf = slide.preview
+        pixbuf = self._get_slide_pixbuf(slide)
 
         if pixbuf is not None:
-            self._preview.set_shape(pixbuf.scale_simple(
-                int(PREVIEW[self._orientation][2] * self._scale),
-                int(PREVIEW[self._orientation][3] * self._scale),
-                GdkPixbuf.InterpType.NEAREST))
+            self._preview.set_shape(pixbuf)
             self._preview.set_layer(MIDDLE)
         else:
             if self._preview is not None:
@@ -861,9 +1225,112 @@ class PortfolioActivity(activity.Activity):
             self._record_button.hide()
             self._playback_button.hide()
 
+        self._prefetch_neighbours(direction)
+
+    def _slide_key(self, slide):
+        ''' Preview cache key for the slide-view sized image '''
+        return (slide.uid, 'slide',
+                int(PREVIEW[self._orientation][2] * self._scale),
+                int(PREVIEW[self._orientation][3] * self._scale),
+                self._orientation)
+
+    def _get_slide_pixbuf(self, slide):
+        ''' Return the preview scaled for slide view, scaling it now
+        if the prefetcher has not done so already. '''
+        if slide.preview is None:
+            return None
+        # Revisiting a slide (e.g., autoplay looping over the deck)
+        # reuses the image we scaled last time.
+        pixbuf = self._cached_slide_pixbuf(slide)
+        if pixbuf is None:
+            pixbuf = self._get_preview(slide)
+            if pixbuf is None:
+                return None
+            key = self._slide_key(slide)
+            if _pixbuf_wh(pixbuf) != key[2:4]:
+                pixbuf = pixbuf.scale_simple(key[2], key[3],
+                                             GdkPixbuf.InterpType.NEAREST)
+                self.preview_cache.put(key, pixbuf)
+        return pixbuf
+
+    def _cached_slide_pixbuf(self, slide):
+        ''' The cached image for slide view, or None. A preview that
+        was decoded at the slide-view size (as image files are) is
+        used as it is, rather than keeping a second copy. '''
+        key = self._slide_key(slide)
+        if key in self.preview_cache:
+            return self.preview_cache.get(key)
+        if slide.preview.key in self.preview_cache:
+            pixbuf = self.preview_cache.get(slide.preview.key)
+            if _pixbuf_wh(pixbuf) == key[2:4]:
+                return pixbuf
+        return None
+
+    def _next_showable(self, i, direction):
+        ''' Index of the next slide that _show_slide would not skip '''
+        for counter in range(len(self._slides)):
+            i = (i + direction) % len(self._slides)
+            if self._slides[i].active and self._slides[i].fav:
+                return i
+        return None
+
+    def _prefetch_neighbours(self, direction=1):
+        ''' Get the slides we are likely to show next ready in the
+        background. '''
+        self._prefetcher.cancel()
+        if self._playing:
+            indices = []
+            i = self.i
+            for n in range(AUTOPLAY_PREFETCH):
+                i = self._next_showable(i, 1)
+                if i is None or i in indices:
+                    break
+                indices.append(i)
+        else:
+            indices = [self._next_showable(self.i, direction),
+                       self._next_showable(self.i, -direction)]
+        for i in indices:
+            if i is None:
+                continue
+            slide = self._slides[i]
+            if slide.preview is None:
+                continue
+            if self._cached_slide_pixbuf(slide) is None:
+                key = self._slide_key(slide)
+                self._prefetcher.request(key, slide.preview, key[2], key[3])
+
+    def _prefetch_ready_cb(self, key, preview, pixbuf, scaled):
+        ''' A prefetched preview is ready (called on the main loop). '''
+        slide = self._uid_to_slide(preview.uid)
+        if slide is None or slide.preview is not preview:
+            return  # The slide has changed since we asked for it.
+        if key != self._slide_key(slide):
+            return  # The screen has changed size since we asked.
+        if self._need_file(preview, pixbuf):
+            self._prefetcher.request(key, preview, key[2], key[3])
+            return
+        if pixbuf is not None:
+            self.preview_cache.put(preview.key, pixbuf)
+        if scaled is not pixbuf:  # Otherwise it is already cached
+            self.preview_cache.put(key, scaled)
+
+    def _get_preview(self, slide):
+        ''' Decode a slide preview on demand. '''
+        if slide.preview is None:
+            return None
+        return slide.preview.get()
+
+    def _drop_thumbs(self):
+        ''' Leaving thumbnail view: the scaled thumbnails stay in the
+        thumbnail pack, so there is no need to keep them on sprites. '''
+        self._cancel_thumb_fill()
+        for slide in list(self._thumb_bound):
+            self._release_thumb(slide)
+
     def _slides_cb(self, button=None):
         if self._thumbnail_mode:
             self._thumbnail_mode = False
+            self._drop_thumbs()
         self.i = self._current_slide
         self._record_button.set_layer(DRAG)
         self._playback_button.set_layer(DRAG)
@@ -877,15 +1344,11 @@ class PortfolioActivity(activity.Activity):
         self._show_thumbs()
         return False
 
-    def _count_active(self):
-        count = 0
-        for slide in self._slides:
-            if slide.active:
-                count += 1
-        return count
-
     def _show_thumbs(self):
+        ''' Lay out the grid right away, with placeholders for any
+        thumbnails we do not have yet; they are filled in when idle. '''
         self._stop_autoplay()
+        self._cancel_thumb_fill()
         self._current_slide = self.i
         self._clear_screen()
 
@@ -894,55 +1357,179 @@ class PortfolioActivity(activity.Activity):
         self._prev.hide()
         self._next.hide()
 
-        n = int(ceil(sqrt(self._count_active())))
+        self._thumb_slides = [slide for slide in self._slides if slide.active]
+        n, w = self._thumb_columns(len(self._thumb_slides))
+        h = int(w * 0.75)  # maintain 4:3 aspect ratio
+        x_off = int((self._width - n * w) / 2)
+        grid = (x_off, max(1, n), w, h)
+        if grid != self._thumb_grid:
+            # The pooled sprites are the wrong size now
+            self._drop_thumbs()
+            self._thumb_pool = []
+            self._thumb_grid = grid
+        self._thumb_scroll = min(self._thumb_scroll, self._max_thumb_scroll())
+        self._layout_thumbs()
+        self.i = 0  # Reset position in slideshow to the beginning
+
+    def _thumb_columns(self, count):
+        ''' How many columns, and how wide, for count thumbnails? '''
+        n = int(ceil(sqrt(count)))
         if n > 0:
             w = int(self._width / n)
         else:
             w = self._width
-        h = int(w * 0.75)  # maintain 4:3 aspect ratio
-        x_off = int((self._width - n * w) / 2)
-        x = x_off
-        y = 0
-        for slide in self._slides:
-            if not slide.active:
-                continue
+        if w < THUMB_MIN_WIDTH * self._scale:
+            # Too many slides to fit on the screen: scroll instead
+            n = max(1, int(self._width / (THUMB_MIN_WIDTH * self._scale)))
+            w = int(self._width / n)
+        return n, w
+
+    def _thumb_xy(self, k):
+        ''' Where does the k-th thumbnail in the grid go? '''
+        x_off, columns, w, h = self._thumb_grid
+        return (x_off + (k % columns) * w,
+                (k // columns) * h - self._thumb_scroll)
+
+    def _max_thumb_scroll(self):
+        x_off, columns, w, h = self._thumb_grid
+        rows = int(ceil(len(self._thumb_slides) / columns))
+        return max(0, rows * h - self._height)
+
+    def _scroll_thumbs(self, dy):
+        ''' Scroll the thumbnail grid by dy pixels. '''
+        if not self._thumbnail_mode or self._press is not None:
+            return
+        scroll = max(0, min(self._thumb_scroll + dy,
+                            self._max_thumb_scroll()))
+        if scroll != self._thumb_scroll:
+            self._thumb_scroll = scroll
+            self._layout_thumbs()
+
+    def _layout_thumbs(self):
+        ''' Give sprites to the slides in or near the viewport, taking
+        them back from slides that have scrolled away, and move them
+        into place. '''
+        self._cancel_thumb_fill()
+        x_off, columns, w, h = self._thumb_grid
+        first = max(0, self._thumb_scroll // h - THUMB_ROW_MARGIN)
+        last = (self._thumb_scroll + self._height) // h + THUMB_ROW_MARGIN
+        start = first * columns
+        end = min(len(self._thumb_slides), (last + 1) * columns)
+        shown = set(self._thumb_slides[start:end])
+
+        self._sprites.defer_inval()
+        for slide in list(self._thumb_bound):
+            if slide not in shown:
+                self._release_thumb(slide)
+        visible = []
+        hidden = []
+        for k in range(start, end):
+            slide = self._thumb_slides[k]
+            x, y = self._thumb_xy(k)
             self._show_thumb(slide, x, y, w, h)
-            x += w
-            if x + w > self._width:
-                x = x_off
-                y += h
-        self.i = 0  # Reset position in slideshow to the beginning
+            if not slide.thumb_ready:
+                if y + h > 0 and y < self._height:
+                    visible.append(slide)
+                else:
+                    hidden.append(slide)
+        self._sprites.flush_inval()
+        self._start_thumb_fill(visible + hidden)
+
+    def _start_thumb_fill(self, slides):
+        ''' Have the decoder make the missing thumbnails, in order. '''
+        for slide in slides:
+            w, h = slide.thumb.get_dimensions()
+            key = (slide.uid, 'thumb', w, h)
+            self._thumb_fill.add(key)
+            self._decoder.request(key, slide.preview, w, h, urgent=True)
+        if len(self._thumb_fill) == 0:
+            self._thumb_pack.flush()
+
+    def _cancel_thumb_fill(self):
+        ''' Stop filling in thumbnails, e.g., when leaving the grid. '''
+        self._decoder.cancel('thumb')
+        self._thumb_fill.clear()
 
     def _show_thumb(self, slide, x, y, w, h):
         ''' Display a preview image and title as a thumbnail. '''
-
-        # Is size has changed, regenerate the thumbnail
-        if slide.thumb is not None:
-            sw, sh = slide.thumb.get_dimensions()
-            if sw == w and sh == h:
-                slide.thumb.move((x, y))
-            else:
-                slide.thumb.hide()
-                slide.thumb = None
         if slide.thumb is None:
-            if slide.preview is not None:
-                pixbuf_thumb = slide.preview.scale_simple(
-                    int(w), int(h), GdkPixbuf.InterpType.TILES)
-            else:
-                pixbuf_thumb = svg_str_to_pixbuf(genblank(int(w), int(h),
-                                                          self._colors))
-            slide.thumb = Sprite(self._sprites, x, y, pixbuf_thumb)
-            # Add a border
-            slide.thumb.set_image(svg_str_to_pixbuf(
-                svg_rectangle(int(w), int(h), slide.colors)), i=1)
+            self._bind_thumb(slide, w, h)
+        slide.thumb.move((x, y))
         slide.thumb.set_layer(TOP)
-        if slide.star is None:
-            self._make_star(slide)
-        slide.star.set_layer(STAR)
         slide.star.move((x, y))
+        slide.star.set_layer(STAR)
+
+    def _bind_thumb(self, slide, w, h):
+        ''' Give a slide thumbnail and star sprites, from the pool if
+        there are any spare. '''
+        # Only use a thumbnail that is ready to hand; the rest are made
+        # by the decoder
+        image = self._find_thumb_image(slide, w, h)
+        slide.thumb_ready = image is not None or slide.preview is None
+        if image is None:
+            image = frame_thumbnail(chrome_pixbuf(BLANK, w, h, self._colors),
+                                    chrome_pixbuf(FRAME, w, h, slide.colors))
+        if len(self._thumb_pool) > 0:
+            thumb, star = self._thumb_pool.pop()
+            thumb.set_image(image)
+        else:
+            thumb = Sprite(self._sprites, 0, 0, image)
+            star = Sprite(self._sprites, 0, 0, self._fav_pixbuf)
+        if slide.fav:
+            star.set_image(self._fav_pixbuf)
+            star.type = 'star'
+        else:
+            star.set_image(self._unfav_pixbuf)
+            star.type = 'unstar'
+        self._slides.set_thumb(slide, thumb)
+        self._slides.set_star(slide, star)
+        self._thumb_bound.add(slide)
+
+    def _release_thumb(self, slide):
+        ''' Put a slide's thumbnail and star sprites back in the pool '''
+        self._thumb_bound.discard(slide)
+        if slide.thumb is None:
+            return
+        slide.thumb.hide()
+        slide.star.hide()
+        self._thumb_pool.append((slide.thumb, slide.star))
+        self._slides.set_thumb(slide, None)
+        self._slides.set_star(slide, None)
+
+    def _find_thumb_image(self, slide, w, h):
+        ''' Find a framed w x h thumbnail in the thumbnail pack (or the
+        preview cache for slides from a sharer) without decoding. '''
+        if slide.preview is None:
+            return None
+        if slide.dsobj is not None:
+            surface = self._thumb_pack.lookup(
+                slide.uid, (slide.stamp, slide.colors), w, h)
+            if surface is not None:
+                return surface
+        pixbuf = self.preview_cache.get((slide.uid, 'thumb', w, h))
+        if pixbuf is None:
+            return None
+        return frame_thumbnail(pixbuf, chrome_pixbuf(FRAME, w, h,
+                                                     slide.colors))
+
+    def _add_thumb_image(self, slide, pixbuf):
+        ''' Keep a newly made thumbnail in the thumbnail pack (or the
+        preview cache for slides from a sharer); return it framed. '''
+        frame = chrome_pixbuf(FRAME, pixbuf.get_width(), pixbuf.get_height(),
+                              slide.colors)
+        if slide.dsobj is not None:
+            # The frame is saved with the thumbnail, so the colors are
+            # part of the stamp
+            return self._thumb_pack.add(slide.uid, (slide.stamp, slide.colors),
+                                        pixbuf, frame)
+        key = (slide.uid, 'thumb', pixbuf.get_width(), pixbuf.get_height())
+        self.preview_cache.put(key, pixbuf)
+        return frame_thumbnail(pixbuf, frame)
 
     def _draw_cb(self, canvas, cr):
-        self._sprites.redraw_sprites(cr=cr)
+        # Only repaint the sprites that overlap the damaged region
+        x1, y1, x2, y2 = cr.clip_extents()
+        self._sprites.redraw_sprites(area=(x1, y1, x2 - x1, y2 - y1), cr=cr)
 
     def write_file(self, file_path):
         ''' Clean up '''
@@ -1184,17 +1771,12 @@ class PortfolioActivity(activity.Activity):
                         self._slide_button.set_active(True)
                     else:  # TODO: test for dragged to beginning
                         i = self._slides.index(press_slide)
-                        n = len(self._slides) - 1
                         press_slide.thumb.move(self._startpos)
                         press_slide.star.move(self._startpos)
                         if self._total_drag[1] > 0:
-                            while i < n:
-                                self._swap_slides(i, i + 1)
-                                i += 1
+                            self._move_slide(i, len(self._slides) - 1)
                         else:
-                            while i > 0:
-                                self._swap_slides(i, i - 1)
-                                i -= 1
+                            self._move_slide(i, 0)
                 # ...and it is not the one we dragged, swap their positions.
                 else:
                     # Could have released on top of a star or a thumbnail
@@ -1216,15 +1798,22 @@ class PortfolioActivity(activity.Activity):
 
     def _swap_slides(self, i, j):
         ''' Swap order and x, y position of two slides '''
-        tmp = self._slides[i]
-        self._slides[i] = self._slides[j]
-        self._slides[j] = tmp
-        xi, yi = self._slides[i].thumb.get_xy()
-        xj, yj = self._slides[j].thumb.get_xy()
-        self._slides[i].thumb.move((xj, yj))
-        self._slides[i].star.move((xj, yj))
-        self._slides[j].thumb.move((xi, yi))
-        self._slides[j].star.move((xi, yi))
+        self._slides.swap(i, j)
+        self._regrid_thumbs()
+
+    def _move_slide(self, i, j):
+        ''' Move slide i to position j, shifting the slides in between
+        along the thumbnail grid, with a single redraw. '''
+        if i == j:
+            return
+        self._slides.move(i, j)
+        self._regrid_thumbs()
+
+    def _regrid_thumbs(self):
+        ''' The slides have been reordered: put the thumbnails on the
+        screen where their slides now fall in the grid. '''
+        self._thumb_slides = [slide for slide in self._slides if slide.active]
+        self._layout_thumbs()
 
     def _unit_combo_cb(self, arg=None):
         ''' Read value of predefined conversion factors from combo box '''
@@ -1388,6 +1977,36 @@ class PortfolioActivity(activity.Activity):
                 self._next_cb()
             elif keyname == 'End':
                 self._last_cb()
+        elif self._thumb_grid is not None:
+            row = self._thumb_grid[3]
+            page = max(row, self._height - row)
+            if keyname == 'Up':
+                self._scroll_thumbs(-row)
+            elif keyname == 'Down':
+                self._scroll_thumbs(row)
+            elif keyname == 'Page_Up':
+                self._scroll_thumbs(-page)
+            elif keyname == 'Page_Down':
+                self._scroll_thumbs(page)
+            elif keyname == 'Home':
+                self._scroll_thumbs(-self._thumb_scroll)
+            elif keyname == 'End':
+                self._scroll_thumbs(self._max_thumb_scroll())
+        return True
+
+    def _scroll_cb(self, win, event):
+        ''' Mouse wheel or touchpad: scroll the thumbnail grid. '''
+        if not self._thumbnail_mode or self._thumb_grid is None:
+            return False
+        row = self._thumb_grid[3]
+        if event.direction == Gdk.ScrollDirection.UP:
+            self._scroll_thumbs(-row)
+        elif event.direction == Gdk.ScrollDirection.DOWN:
+            self._scroll_thumbs(row)
+        elif event.direction == Gdk.ScrollDirection.SMOOTH:
+            self._scroll_thumbs(int(event.delta_y * row))
+        else:
+            return False
         return True
 
     def _unselect(self):
@@ -1447,12 +2066,13 @@ class PortfolioActivity(activity.Activity):
     def _dump(self, slide):
         ''' Dump data for sharing.'''
         _logger.debug('dumping %s' % (slide.uid))
-        if slide.preview is None:
+        pixbuf = self._get_preview(slide)
+        if pixbuf is None:
             data = [slide.uid, slide.title, None, slide.description,
                     slide.comment]
         else:
             data = [slide.uid, slide.title,
-                    pixbuf_to_base64(activity, slide.preview,
+                    pixbuf_to_base64(activity, pixbuf,
                                      width=300, height=225),
                     slide.description, slide.comment]
         return self._data_dumper(data)
@@ -1469,7 +2089,8 @@ class PortfolioActivity(activity.Activity):
             if base64 is None:
                 preview = None
             else:
-                preview = base64_to_pixbuf(activity, base64)
+                preview = Preview(uid, 300, 225,
+                                  pixbuf=base64_to_pixbuf(activity, base64))
             self._slides.append(Slide(self._buddies[-1],
                                       uid,
                                       self._colors,
@@ -1481,10 +2102,12 @@ class PortfolioActivity(activity.Activity):
             _logger.debug('updating description for %s' % (uid))
             slide = self._uid_to_slide(uid)
             slide.title = title
+            self.preview_cache.invalidate(uid)
             if base64 is None:
                 slide.preview = None
             else:
-                slide.preview = base64_to_pixbuf(activity, base64)
+                slide.preview = Preview(
+                    uid, 300, 225, pixbuf=base64_to_pixbuf(activity, base64))
             slide.description = description
             slide.comment = comment
             slide.active = True
@@ -1649,18 +2272,14 @@ class PortfolioActivity(activity.Activity):
         colors = self._data_loader(data)
         colors[0] = str(colors[0])
         colors[1] = str(colors[1])
-        self._my_canvas.set_image(svg_str_to_pixbuf(
-            genblank(self._width, self._height, [colors[0], colors[0]])))
-        self._title.set_image(
-            svg_str_to_pixbuf(genblank(
-                int(self._title_wh[0]), int(self._title_wh[1]), colors)))
-        self._description.set_image(
-            svg_str_to_pixbuf(genblank(
-                int(self._desc_wh[0]), int(self._desc_wh[1]), colors)))
-        self._comment.set_image(
-            svg_str_to_pixbuf(genblank(
-                int(self._comment_wh[0]), int(self._comment_wh[1]),
-                colors)))
+        self._my_canvas.set_image(chrome_pixbuf(
+            BLANK, self._width, self._height, [colors[0], colors[0]]))
+        self._title.set_image(chrome_pixbuf(
+            BLANK, self._title_wh[0], self._title_wh[1], colors))
+        self._description.set_image(chrome_pixbuf(
+            BLANK, self._desc_wh[0], self._desc_wh[1], colors))
+        self._comment.set_image(chrome_pixbuf(
+            BLANK, self._comment_wh[0], self._comment_wh[1], colors))
         # Don't update new_comment colors
 
     def _update_comment(self, data):
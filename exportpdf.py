@@ -10,12 +10,17 @@
 # along with this library; if not, write to the Free Software
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
-import os.path
+import os
 import time
 import json
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, current_thread, main_thread
 
 import gi
 gi.require_version('Gtk', '3.0')
+from gi.repository import GLib
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
 from gi.repository import Pango
@@ -26,7 +31,7 @@ import cairo
 
 from gettext import gettext as _
 
-from utils import get_pixbuf_from_journal, parse_comments
+from utils import parse_comments
 
 import logging
 _logger = logging.getLogger("portfolio-activity")
@@ -36,78 +41,365 @@ PAGE_WIDTH = 504
 PAGE_HEIGHT = 648
 LEFT_MARGIN = 10
 TOP_MARGIN = 20
+SCREEN_DPI = 72  # cairo PDF units are points
 
+PAGE_CACHE_BUDGET = 16 * 1024 * 1024  # bytes of JPEG data
+PREPARE_BATCH = 8  # image files looked up per trip to the main loop
 
-def save_pdf(activity, nick, description=None):
-    ''' Output a PDF document from the title, pictures, and descriptions '''
 
-    if len(activity.dsobjects) == 0:
-        return None
+class _Page():
 
-    head = activity.title_size
-    body = activity.desc_size / 2
+    ''' What goes on one page, collected on the main loop so that the
+    page can be drawn in another thread '''
 
-    tmp_file = os.path.join(activity.datapath, 'output.pdf')
-    pdf_surface = cairo.PDFSurface(tmp_file, 504, 648)
+    def __init__(self, uid, title, text, preview=None):
+        self.uid = uid
+        self.title = title
+        self.text = text
+        self.preview = preview  # the slide's Preview handle
+        self.small = None  # the decoded preview, from the preview cache
+        self.digest = None  # of everything that goes on the page
+        self.image = None  # the picture from an earlier export
+        self.needs_file = False  # must the image file be looked up?
 
-    fd = Pango.FontDescription('Sans')
-    cr = cairo.Context(pdf_surface)
-    cr.set_source_rgb(0, 0, 0)
 
-    show_text(cr, fd, nick, head, LEFT_MARGIN, TOP_MARGIN)
-    show_text(cr, fd, time.strftime('%x', time.localtime()),
-              body, LEFT_MARGIN, TOP_MARGIN + 3 * head)
-    if description is not None:
-        show_text(cr, fd, description,
-                  body, LEFT_MARGIN, TOP_MARGIN + 4 * head)
-    cr.show_page()
+def _image_size(image):
+    ''' How many bytes of JPEG data does a page image hold? '''
+    jpeg = image[4]
+    if jpeg is None:
+        return 0
+    return len(jpeg[0])
 
-    for i, dsobj in enumerate(activity.dsobjects):
-        if dsobj.metadata['keep'] == '0':
-            continue
-        if 'title' in dsobj.metadata:
-            show_text(cr, fd, dsobj.metadata['title'], head, LEFT_MARGIN,
-                      TOP_MARGIN)
-        else:
-            show_text(cr, fd, _('untitled'), head, LEFT_MARGIN,
-                      TOP_MARGIN)
-
-        w = 0
-        h = 0
-        pixbuf = None
-        if os.path.exists(dsobj.file_path):
-            try:
-                w = int(PAGE_WIDTH - LEFT_MARGIN * 2)
-                h = int(w * 3 / 4)
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    dsobj.file_path, w, h)
-            except:
-                try:
-                    w = 300
-                    h = 225
-                    pixbuf = get_pixbuf_from_journal(dsobj, w, h)
-                except:
-                    pass
 
-        if pixbuf is not None:
+class PageCache():
+
+    ''' The pictures on the pages of earlier exports, as JPEG data (not
+    decoded pixels), each with a digest of everything that went into
+    its page. The least recently used pages are forgotten when the JPEG
+    data grows past the budget. Only used from the main loop. '''
+
+    def __init__(self, budget=PAGE_CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self._pages = OrderedDict()  # uid: (digest, image)
+
+    def get(self, uid, digest):
+        ''' Return the picture for a slide's page, if the page is still
+        up to date '''
+        entry = self._pages.get(uid)
+        if entry is None or entry[0] != digest:
+            return None
+        self._pages.move_to_end(uid)
+        return entry[1]
+
+    def put(self, uid, digest, image):
+        self.remove(uid)
+        size = _image_size(image)
+        if size > self.budget:
+            return
+        self._pages[uid] = (digest, image)
+        self.size += size
+        while self.size > self.budget:
+            old_uid, (old_digest, old_image) = self._pages.popitem(
+                last=False)
+            self.size -= _image_size(old_image)
+
+    def remove(self, uid):
+        if uid in self._pages:
+            self.size -= _image_size(self._pages.pop(uid)[1])
+
+    def keep(self, uids):
+        ''' Forget the pages of slides that are not being exported '''
+        for uid in list(self._pages.keys()):
+            if uid not in uids:
+                self.remove(uid)
+
+
+class PDFExporter():
+
+    ''' Write the slides that are shown (active and starred), in the
+    order they are shown in, as a PDF. The page data is collected from
+    the slides when the exporter is made (on the main loop); the images
+    are decoded and scaled on a pool of worker threads a few pages ahead
+    of the writer, which draws the pages in order. start() writes in a
+    thread of its own, calling progress_cb(pages done, pages) and
+    done_cb(path, or None if there was nothing to write or the export
+    was cancelled) on the main loop; run() writes in the calling
+    thread.
+
+    Images are decoded at dpi. If jpeg_quality is given, they are
+    embedded as JPEG data at that quality rather than as raw pixels,
+    and an image that appears on more than one page is only embedded
+    once.
+
+    The JPEG data of each picture is kept in the activity's page_cache,
+    so exporting again only decodes the pictures of slides that have
+    changed. The image files of the other pages are looked up in the
+    datastore on the main loop, a few pages at a time, just ahead of
+    the decoders. '''
+
+    def __init__(self, activity, nick, slides, description=None,
+                 progress_cb=None, done_cb=None, dpi=SCREEN_DPI,
+                 jpeg_quality=None):
+        self._path = os.path.join(activity.datapath, 'output.pdf')
+        self._cache = activity.preview_cache
+        self._page_cache = activity.page_cache
+        self._nick = nick
+        self._description = description
+        self._head = activity.title_size
+        self._body = activity.desc_size / 2
+        self._progress_cb = progress_cb
+        self._done_cb = done_cb
+        self._dpi = dpi
+        self._jpeg_quality = jpeg_quality
+        self._workers = os.cpu_count() or 1
+        self._cancelled = Event()
+        self._thread = None
+        self._pages = []
+        for slide in slides:
+            if not slide.active or not slide.fav:
+                continue
+            if slide.title:
+                title = slide.title
+            else:
+                title = _('untitled')
+            text = slide.description
+            if len(slide.comment) > 0:
+                text += '\n'
+                text += parse_comments(slide.comment)
+            page = _Page(slide.uid, title, text, preview=slide.preview)
+            self._add_page(page, slide.stamp)
+        self._page_cache.keep(set([page.uid for page in self._pages]))
+
+    def _add_page(self, page, stamp):
+        ''' Use the page from the last export if nothing on it has
+        changed; otherwise get what we need to draw it. '''
+        if stamp is not None:  # Slides from a sharer have no stamp
+            key = [page.title, page.text, repr(stamp), self._dpi,
+                   self._jpeg_quality, self._head, self._body]
+            page.digest = hashlib.sha1(
+                json.dumps(key).encode('utf-8')).hexdigest()
+            page.image = self._page_cache.get(page.uid, page.digest)
+        if page.image is None and page.preview is not None:
+            # The saved copy will do if it is as big as the picture on
+            # the page; otherwise the image file is decoded again
+            if not page.preview.stored() or \
+               page.preview.width < _page_image_size(self._dpi)[0]:
+                page.needs_file = True
+            if page.preview.key in self._cache:
+                page.small = self._cache.get(page.preview.key)
+        self._pages.append(page)
+
+    def _prepare(self, pages):
+        ''' Look up the image files the pages need in the datastore,
+        which may only be done on the main loop (called from the writer
+        thread, which waits for the main loop to do it) '''
+        pages = [page for page in pages if page.needs_file]
+        if len(pages) == 0:
+            return
+        if current_thread() is main_thread():
+            self._prepare_cb(pages)
+            return
+        done = Event()
+        GLib.idle_add(self._prepare_cb, pages, done)
+        while not done.wait(0.1):
+            if self._cancelled.is_set():
+                return
+
+    def _prepare_cb(self, pages, done=None):
+        for page in pages:
+            page.preview.prepare()  # Anything that talks to the datastore
+            page.needs_file = False
+        if done is not None:
+            done.set()
+        return False
+
+    def start(self):
+        self._thread = Thread(target=self._run_in_thread, daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _draw_page(self, cr, fd, page, image, surfaces):
+        ''' Draw the title, picture and text of a slide '''
+        show_text(cr, fd, page.title, self._head, LEFT_MARGIN, TOP_MARGIN)
+
+        w, h, scale, pixbuf, jpeg = image
+        if pixbuf is not None or jpeg is not None:
             cr.save()
-            Gdk.cairo_set_source_pixbuf(
-                cr, pixbuf, LEFT_MARGIN, TOP_MARGIN + 150)
-            cr.rectangle(LEFT_MARGIN, TOP_MARGIN + 150, w, h)
+            cr.translate(LEFT_MARGIN, TOP_MARGIN + 150)
+            cr.scale(scale, scale)
+            if jpeg is not None:
+                digest = jpeg[1]
+                if digest not in surfaces:
+                    surfaces[digest] = _jpeg_surface(*jpeg)
+                cr.set_source_surface(surfaces[digest], 0, 0)
+            else:
+                Gdk.cairo_set_source_pixbuf(cr, pixbuf, 0, 0)
+            cr.rectangle(0, 0, w / scale, h / scale)
             cr.fill()
             cr.restore()
+        else:
+            w = 0
+            h = 0
+
+        show_text(cr, fd, page.text, self._body, LEFT_MARGIN, h + 175)
+
+    def _run_in_thread(self):
+        path = None
+        try:
+            path = self.run()
+        except Exception as e:
+            _logger.error('could not export PDF: %s' % (e))
+            if os.path.exists(self._path):
+                try:
+                    os.remove(self._path)
+                except OSError:
+                    pass
+        finally:
+            if self._done_cb is not None:
+                GLib.idle_add(self._done_cb, path)
 
-        text = ''
-        if 'description' in dsobj.metadata:
-            text += dsobj.metadata['description']
-        if 'comments' in dsobj.metadata:
-            text += '\n'
-            text += parse_comments(json.loads(dsobj.metadata['comments']))
-        show_text(cr, fd, text, body, LEFT_MARGIN, h + 175)
+    def run(self):
+        ''' Write the PDF; return its path, or None '''
+        if len(self._pages) == 0:
+            return None
 
+        head = self._head
+        body = self._body
+
+        pdf_surface = cairo.PDFSurface(self._path, 504, 648)
+
+        fd = Pango.FontDescription('Sans')
+        cr = cairo.Context(pdf_surface)
+        cr.set_source_rgb(0, 0, 0)
+
+        show_text(cr, fd, self._nick, head, LEFT_MARGIN, TOP_MARGIN)
+        show_text(cr, fd, time.strftime('%x', time.localtime()),
+                  body, LEFT_MARGIN, TOP_MARGIN + 3 * head)
+        if self._description is not None:
+            show_text(cr, fd, self._description,
+                      body, LEFT_MARGIN, TOP_MARGIN + 4 * head)
         cr.show_page()
 
-    return tmp_file
+        executor = ThreadPoolExecutor(max_workers=self._workers)
+        images = []  # futures for the page images, in page order
+        surfaces = {}  # JPEG surfaces by digest, to share between pages
+        prepared = 0  # how many pages have had their files looked up
+        try:
+            for i, page in enumerate(self._pages):
+                # Keep the decoders a few pages ahead of us
+                while len(images) < min(len(self._pages),
+                                        i + self._workers * 2):
+                    if len(images) == prepared:
+                        prepared = min(len(self._pages),
+                                       prepared + PREPARE_BATCH)
+                        self._prepare(self._pages[len(images):prepared])
+                        if self._cancelled.is_set():
+                            break
+                    ahead = self._pages[len(images)]
+                    if ahead.image is None:
+                        images.append(executor.submit(
+                            _get_page_image, ahead, self._dpi,
+                            self._jpeg_quality))
+                    else:
+                        images.append(None)  # Nothing to decode
+                if self._cancelled.is_set():
+                    break
+
+                image = page.image
+                if image is None:
+                    image = images[i].result()
+                    w, h, scale, pixbuf, jpeg = image
+                    # Only keep pictures that need no pixels to draw again
+                    if page.digest is not None and \
+                       (pixbuf is None or jpeg is not None):
+                        GLib.idle_add(self._page_cache.put, page.uid,
+                                      page.digest, (w, h, scale, None, jpeg))
+                images[i] = None
+
+                self._draw_page(cr, fd, page, image, surfaces)
+                cr.show_page()
+                if self._progress_cb is not None:
+                    GLib.idle_add(self._progress_cb, i + 1, len(self._pages))
+        finally:
+            for image in images:
+                if image is not None:
+                    image.cancel()
+            executor.shutdown(wait=False)
+            pdf_surface.finish()
+
+        if self._cancelled.is_set():
+            os.remove(self._path)
+            return None
+        return self._path
+
+
+def _page_image_size(dpi=SCREEN_DPI):
+    ''' The size of the picture on the page, in pixels at dpi '''
+    w = int((PAGE_WIDTH - LEFT_MARGIN * 2) * dpi / SCREEN_DPI)
+    return w, int(w * 3 / 4)
+
+
+def _get_page_pixbuf(page, dpi):
+    ''' Decode a page-sized image. Return the size of the picture on
+    the page, in points, the points per pixel, and the pixbuf. Page-sized
+    images are not kept in the preview cache, which would push out the
+    previews and thumbnails. '''
+    w, h = _page_image_size()
+    scale = SCREEN_DPI / dpi
+    if page.preview is None:
+        return w, h, scale, None
+    if page.preview.has_file():
+        pw, ph = _page_image_size(dpi)
+        pixbuf = page.preview.decode(pw, ph)
+        if pixbuf is not None:
+            return w, h, scale, pixbuf
+    # Otherwise, use the preview, at no more than a pixel per point
+    pixbuf = page.small
+    if pixbuf is None:
+        pixbuf = page.preview.load()
+    if pixbuf is None:
+        return w, h, scale, None
+    scale = min(1, w / pixbuf.get_width())
+    return (int(pixbuf.get_width() * scale),
+            int(pixbuf.get_height() * scale), scale, pixbuf)
+
+
+def _get_page_image(page, dpi, jpeg_quality):
+    ''' Decode (and, if jpeg_quality is given, JPEG encode) a page
+    image (called from a worker thread). The JPEG is returned as its
+    data, digest and size in pixels. '''
+    w, h, scale, pixbuf = _get_page_pixbuf(page, dpi)
+    if pixbuf is None or jpeg_quality is None:
+        return w, h, scale, pixbuf, None
+    opaque = pixbuf
+    if pixbuf.get_has_alpha():
+        # JPEG has no alpha, so flatten the image onto white paper
+        opaque = pixbuf.composite_color_simple(
+            pixbuf.get_width(), pixbuf.get_height(),
+            GdkPixbuf.InterpType.NEAREST, 255, 8, 0xffffff, 0xffffff)
+    try:
+        ok, jpeg = opaque.save_to_bufferv('jpeg', ['quality'],
+                                          [str(jpeg_quality)])
+    except GLib.Error as e:
+        _logger.debug('could not encode %s as JPEG: %s' % (page.uid, e))
+        return w, h, scale, pixbuf, None
+    return w, h, scale, pixbuf, (jpeg, hashlib.sha1(jpeg).hexdigest(),
+                                 pixbuf.get_width(), pixbuf.get_height())
+
+
+def _jpeg_surface(jpeg, digest, width, height):
+    ''' A surface that cairo will write to the PDF as the JPEG data.
+    The pixels themselves are never read, so they are left blank. '''
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    surface.set_mime_data(cairo.MIME_TYPE_JPEG, jpeg)
+    if hasattr(cairo, 'MIME_TYPE_UNIQUE_ID'):
+        # Lets cairo share the image even between different surfaces
+        surface.set_mime_data(cairo.MIME_TYPE_UNIQUE_ID,
+                              digest.encode('utf-8'))
+    return surface
 
 
 def show_text(cr, fd, label, size, x, y):
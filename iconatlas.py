@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011-2013 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import json
+import hashlib
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+import logging
+_logger = logging.getLogger("portfolio-activity")
+
+ATLAS_KEEP = 8  # How many atlases to keep in the cache directory
+
+
+class IconAtlas():
+
+    ''' The icons in a directory, rasterized once at one size into a
+    single pixbuf. The atlas is saved in cache_dir so that the next
+    launch can load one PNG instead of rasterizing every SVG. '''
+
+    def __init__(self, cache_dir, icon_dir, width, height, names=None):
+        if names is None:
+            names = sorted([name for name in os.listdir(icon_dir)
+                            if name.endswith('.svg')])
+        self._width = int(width)
+        self._height = int(height)
+        self._index = {}
+        self._atlas = None
+
+        paths = [os.path.join(icon_dir, name) for name in names]
+        key = [self._width, self._height]
+        for path in paths:
+            key.append([path, os.path.getmtime(path)])
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        png = os.path.join(cache_dir, 'atlas-%s.png' % (digest))
+        index = os.path.join(cache_dir, 'atlas-%s.json' % (digest))
+
+        if os.path.exists(png) and os.path.exists(index):
+            try:
+                self._atlas = GdkPixbuf.Pixbuf.new_from_file(png)
+                with open(index) as f:
+                    self._index = json.load(f)
+                os.utime(png)  # Recently used
+                return
+            except (GLib.Error, OSError, ValueError) as e:
+                _logger.debug('could not load icon atlas: %s' % (e))
+                self._index = {}
+
+        self._build(paths)
+        try:
+            self._atlas.savev(png, 'png', [], [])
+            with open(index, 'w') as f:
+                json.dump(self._index, f)
+        except (GLib.Error, OSError) as e:
+            _logger.debug('could not save icon atlas: %s' % (e))
+        _prune(cache_dir)
+
+    def _build(self, paths):
+        ''' Rasterize the icons side by side '''
+        self._atlas = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                           max(1, self._width * len(paths)),
+                                           self._height)
+        self._atlas.fill(0)
+        for i, path in enumerate(paths):
+            icon = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                path, self._width, self._height)
+            w = icon.get_width()
+            h = icon.get_height()
+            icon.copy_area(0, 0, w, h, self._atlas, i * self._width, 0)
+            self._index[os.path.basename(path)] = [i * self._width, 0, w, h]
+
+    def get(self, name):
+        ''' Return the pixbuf for an icon (sharing the atlas pixels) '''
+        x, y, w, h = self._index[name]
+        return self._atlas.new_subpixbuf(x, y, w, h)
+
+
+def _prune(cache_dir):
+    ''' Remove all but the most recently used atlases '''
+    atlases = [os.path.join(cache_dir, name)
+               for name in os.listdir(cache_dir)
+               if name.startswith('atlas-') and name.endswith('.png')]
+    atlases.sort(key=os.path.getmtime, reverse=True)
+    for png in atlases[ATLAS_KEEP:]:
+        for path in [png, png[:-4] + '.json']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
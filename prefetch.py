@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011-2013 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Thread
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+import logging
+_logger = logging.getLogger("portfolio-activity")
+
+
+def _decode(preview, width, height, interp):
+    ''' Decode a preview and (if a size is given) scale it '''
+    pixbuf = preview.load()
+    if pixbuf is None or width is None:
+        return pixbuf, None
+    if pixbuf.get_width() == width and pixbuf.get_height() == height:
+        return pixbuf, pixbuf  # Already the right size
+    return pixbuf, pixbuf.scale_simple(width, height, interp)
+
+
+class Prefetcher():
+
+    ''' Decode and scale slide previews in a worker thread. Finished
+    pixbufs are handed back to the GTK main loop through ready_cb. '''
+
+    def __init__(self, ready_cb):
+        self._ready_cb = ready_cb
+        self._queue = Queue()
+        self._pending = set()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, key, preview, width, height):
+        ''' Ask for a preview scaled to width x height (called from
+        the main loop) '''
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        if not preview.stored():
+            preview.prepare()  # Anything that talks to the datastore
+        self._queue.put((key, preview, width, height))
+
+    def cancel(self):
+        ''' Forget about any requests that have not been started '''
+        while True:
+            try:
+                key, preview, width, height = self._queue.get_nowait()
+            except Empty:
+                break
+            self._pending.discard(key)
+
+    def stop(self):
+        self.cancel()
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            key, preview, width, height = job
+            pixbuf, scaled = _decode(preview, width, height,
+                                     GdkPixbuf.InterpType.NEAREST)
+            GLib.idle_add(self._deliver, key, preview, pixbuf, scaled)
+
+    def _deliver(self, key, preview, pixbuf, scaled):
+        self._pending.discard(key)
+        self._ready_cb(key, preview, pixbuf, scaled)
+        return False
+
+
+class DecodePool():
+
+    ''' Decode (and scale) many previews at once on a pool of worker
+    threads, one per core; GdkPixbuf lets go of the GIL while it
+    decodes. Results are handed back to the GTK main loop through
+    ready_cb in the order they were asked for. Only a few jobs are given
+    to the pool at a time, so urgent requests do not wait behind a long
+    queue. Keys are tuples of (uid, kind, ...), as in the PixbufCache. '''
+
+    def __init__(self, ready_cb, workers=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._workers = workers
+        self._ready_cb = ready_cb
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._urgent = deque()
+        self._waiting = deque()
+        self._running = deque()  # (key, preview, future), in order
+
+    def request(self, key, preview, width=None, height=None, urgent=False):
+        ''' Ask for a preview, scaled to width x height if given
+        (called from the main loop) '''
+        job = (key, preview, width, height)
+        if urgent:
+            self._urgent.append(job)
+        else:
+            self._waiting.append(job)
+        self._submit()
+
+    def cancel(self, kind=None):
+        ''' Forget requests (of one kind, if given) that have not been
+        delivered yet '''
+        for jobs in [self._urgent, self._waiting]:
+            keep = [job for job in jobs
+                    if kind is not None and job[0][1] != kind]
+            jobs.clear()
+            jobs.extend(keep)
+        keep = []
+        for job in self._running:
+            if kind is None or job[0][1] == kind:
+                job[2].cancel()
+            else:
+                keep.append(job)
+        self._running.clear()
+        self._running.extend(keep)
+
+    def stop(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _submit(self):
+        while len(self._running) < self._workers * 2:
+            if len(self._urgent) > 0:
+                key, preview, width, height = self._urgent.popleft()
+            elif len(self._waiting) > 0:
+                key, preview, width, height = self._waiting.popleft()
+            else:
+                break
+            if not preview.stored():
+                preview.prepare()  # Anything that talks to the datastore
+            future = self._executor.submit(_decode, preview, width, height,
+                                           GdkPixbuf.InterpType.TILES)
+            self._running.append((key, preview, future))
+            future.add_done_callback(self._done)
+
+    def _done(self, future):
+        ''' A job has finished (called from a worker thread) '''
+        GLib.idle_add(self._merge)
+
+    def _merge(self):
+        ''' Deliver finished jobs, in the order they were asked for '''
+        while len(self._running) > 0 and self._running[0][2].done():
+            key, preview, future = self._running.popleft()
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                _logger.error('could not decode preview for %s: %s' %
+                              (preview.uid, future.exception()))
+                continue
+            pixbuf, scaled = future.result()
+            self._ready_cb(key, preview, pixbuf, scaled)
+        self._submit()
+        return False
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011-2013 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+from collections import OrderedDict
+
+from gi.repository import GLib
+
+from utils import get_pixbuf_from_file, get_pixbuf_from_journal
+
+import logging
+_logger = logging.getLogger("portfolio-activity")
+
+# Where the preview comes from
+FILE = 'file'  # an image file in the Journal
+JOURNAL = 'journal'  # the preview stored in the Journal metadata
+PIXBUF = 'pixbuf'  # already decoded (e.g., received from a sharer)
+
+DEFAULT_BUDGET = 32 * 1024 * 1024  # bytes of decoded pixels
+
+
+def pixbuf_size(pixbuf):
+    ''' How many bytes of pixel data does a pixbuf hold? '''
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class PixbufCache():
+
+    ''' A least-recently-used cache of decoded pixbufs with a budget
+    in bytes. Keys are tuples of the slide uid, the kind of image
+    ('preview', 'slide', 'thumb', ...), and whatever else is needed
+    to tell variants apart, such as size. '''
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pixbufs = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._pixbufs
+
+    def get(self, key):
+        ''' Return a cached pixbuf (or None) and mark it as recently used '''
+        if key not in self._pixbufs:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pixbufs.move_to_end(key)
+        return self._pixbufs[key]
+
+    def put(self, key, pixbuf):
+        ''' Add a pixbuf, evicting the least-recently used ones if we
+        are over budget '''
+        self.remove(key)
+        if pixbuf is None:
+            return
+        size = pixbuf_size(pixbuf)
+        if size > self.budget:
+            return
+        self._pixbufs[key] = pixbuf
+        self.size += size
+        while self.size > self.budget:
+            old_key, old_pixbuf = self._pixbufs.popitem(last=False)
+            self.size -= pixbuf_size(old_pixbuf)
+            self.evictions += 1
+
+    def remove(self, key):
+        ''' Forget a cached pixbuf '''
+        if key in self._pixbufs:
+            self.size -= pixbuf_size(self._pixbufs.pop(key))
+
+    def invalidate(self, uid):
+        ''' Forget every pixbuf cached for a slide '''
+        for key in [key for key in self._pixbufs if key[0] == uid]:
+            self.remove(key)
+
+    def invalidate_kind(self, kind):
+        ''' Forget every pixbuf of one kind, e.g., all of the images
+        scaled for a screen size that no longer applies '''
+        for key in [key for key in self._pixbufs if key[1] == kind]:
+            self.remove(key)
+
+    def clear(self):
+        self._pixbufs.clear()
+        self.size = 0
+
+    def stats(self):
+        ''' Report how well the cache is doing '''
+        return {'entries': len(self._pixbufs), 'size': self.size,
+                'budget': self.budget, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class Preview():
+
+    ''' A handle to a slide preview that is only decoded when needed '''
+
+    def __init__(self, uid, width, height, dsobj=None, kind=PIXBUF,
+                 pixbuf=None, cache=None, store=None, stamp=None):
+        self.uid = uid
+        self.stamp = stamp  # When the Journal entry last changed
+        self.width = width
+        self.height = height
+        self.kind = kind
+        self.key = (uid, 'preview')
+        self._dsobj = dsobj
+        self._file_path = None
+        self._pixbuf = pixbuf  # Only kept for previews with no source
+        self._cache = cache
+        self._store = store  # A ThumbnailStore for decoded image files
+
+    def prepare(self):
+        ''' Look up the file in the datastore. This needs to happen on
+        the main loop before decode() is called from another thread. '''
+        if self.kind == FILE and self._file_path is None:
+            self._file_path = self._dsobj.file_path
+
+    def has_file(self):
+        ''' Has prepare() found the image file to decode? '''
+        return self.kind == FILE and self._file_path is not None
+
+    def decode(self, width=None, height=None):
+        ''' Decode the preview from its source (an image file can be
+        decoded at another size, e.g., for printing) '''
+        if self.kind == PIXBUF:
+            return self._pixbuf
+        if width is None:
+            width = self.width
+            height = self.height
+        try:
+            if self.kind == FILE:
+                if self._file_path is None:
+                    # Only the main loop may talk to the datastore, and
+                    # we could be in another thread
+                    _logger.error('no file to decode for %s' % (self.uid))
+                    return None
+                return get_pixbuf_from_file(self._file_path, width, height)
+            return get_pixbuf_from_journal(self._dsobj, 300, 225)
+        except GLib.Error as e:
+            _logger.error('could not decode preview for %s: %s' %
+                          (self.uid, e))
+            return None
+
+    def load(self):
+        ''' Like decode, but use the copy saved on disk by an earlier
+        launch if there is one (and save one if not). '''
+        if self.kind != FILE or self._store is None:
+            return self.decode()
+        pixbuf = self._store.lookup(self.uid, self.stamp,
+                                    self.width, self.height)
+        if pixbuf is None:
+            pixbuf = self.decode()
+            if pixbuf is not None:
+                self._store.store(self.uid, self.stamp,
+                                  self.width, self.height, pixbuf)
+        return pixbuf
+
+    def stored(self):
+        ''' Can load() do without decoding the source? '''
+        if self.kind != FILE or self._store is None:
+            return self.kind == PIXBUF
+        return self._store.contains(self.uid, self.stamp,
+                                    self.width, self.height)
+
+    def get(self):
+        ''' Return the decoded pixbuf, decoding it if necessary (called
+        from the main loop) '''
+        if self.kind == PIXBUF:
+            return self._pixbuf
+        if self._cache is not None:
+            pixbuf = self._cache.get(self.key)
+            if pixbuf is not None:
+                return pixbuf
+        if not self.stored():
+            self.prepare()
+        pixbuf = self.load()
+        if pixbuf is None and self.kind == FILE and self._file_path is None:
+            # The saved copy could not be read, so go to the source
+            self.prepare()
+            pixbuf = self.load()
+        if self._cache is not None:
+            self._cache.put(self.key, pixbuf)
+        return pixbuf
+
+    def release(self):
+        ''' Forget the decoded pixbuf; it can be decoded again later '''
+        if self._cache is not None:
+            self._cache.remove(self.key)
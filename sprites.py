@@ -39,7 +39,8 @@ Example usage:
         # Create a new sprite collection associated with your widget
         self.sprite_list = Sprites(widget)
 
-        # Create a "pixbuf" (in this example, from SVG).
+        # Create a "pixbuf" (in this example, from SVG). A
+        # cairo.ImageSurface can be used as an image too.
         my_pixbuf = svg_str_to_pixbuf("<svg>...some svg code...</svg>")
 
         # Create a sprite at position x1, y1.
@@ -76,9 +77,15 @@ def svg_str_to_pixbuf(svg_string):
 
 '''
 
+from bisect import insort
+
+import cairo
+
 from gi.repository import GdkPixbuf, Gdk
 from gi.repository import Pango, PangoCairo
 
+GRID_SIZE = 128  # Size in pixels of a cell in the hit-testing grid
+
 
 class Sprites:
 
@@ -87,52 +94,134 @@ class Sprites:
     def __init__(self, widget):
         ''' Initialize an empty array of sprites '''
         self.widget = widget
-        self.list = []
+        # The visible sprites are kept in a bucket per layer. Each
+        # bucket is a dict used as an ordered set, so adding or
+        # removing a sprite is O(1) and drawing order is layer order,
+        # then the order in which sprites joined the layer.
+        self._layers = {}
+        self._layer_order = []  # sorted list of layers in use
+        self._length = 0
+        self._count = 0  # orders sprites within a layer
+        # A uniform grid over the canvas: which visible sprites
+        # overlap each cell, so find_sprite only tests a few sprites
+        self._grid = {}
+        self._cells = {}  # sprite: cells it is in
+        self._damage = None  # Pending invalidation, while deferred
 
     def set_cairo_context(self, cr):
         ''' Cairo context may be set or reset after __init__ '''
         self.cr = cr
 
+    @property
+    def list(self):
+        ''' The visible sprites, bottom to top '''
+        return list(self._bottom_to_top())
+
+    def _bottom_to_top(self):
+        for layer in self._layer_order:
+            for spr in self._layers[layer]:
+                yield spr
+
     def get_sprite(self, i):
         ''' Return a sprint from the array '''
-        if i < 0 or i > len(self.list) - 1:
+        if i < 0 or i > self._length - 1:
             return(None)
         else:
             return(self.list[i])
 
     def length_of_list(self):
         ''' How many sprites are there? '''
-        return(len(self.list))
+        return(self._length)
 
     def append_to_list(self, spr):
-        ''' Append a new sprite to the end of the list. '''
-        self.list.append(spr)
+        ''' Append a sprite to the top of its layer. '''
+        if spr.layer not in self._layers:
+            self._layers[spr.layer] = {}
+            insort(self._layer_order, spr.layer)
+        if spr not in self._layers[spr.layer]:
+            self._layers[spr.layer][spr] = None
+            self._length += 1
+            self._count += 1
+            spr.z = self._count
+            self._add_to_grid(spr)
 
     def insert_in_list(self, spr, i):
-        ''' Insert a sprite at position i. '''
-        if i < 0:
-            self.list.insert(0, spr)
-        elif i > len(self.list) - 1:
-            self.list.append(spr)
-        else:
-            self.list.insert(i, spr)
+        ''' Sprites are ordered by layer, so this is the same as
+        append_to_list; i is ignored. '''
+        self.append_to_list(spr)
 
     def remove_from_list(self, spr):
         ''' Remove a sprite from the list. '''
-        if spr in self.list:
-            self.list.remove(spr)
+        if spr in self._layers.get(spr.layer, {}):
+            del self._layers[spr.layer][spr]
+            self._length -= 1
+            self._remove_from_grid(spr)
+
+    def in_list(self, spr):
+        ''' Is the sprite visible? '''
+        return spr in self._layers.get(spr.layer, {})
+
+    def _add_to_grid(self, spr):
+        x, y, w, h = spr.rect
+        cells = []
+        for col in range(x // GRID_SIZE, (x + w) // GRID_SIZE + 1):
+            for row in range(y // GRID_SIZE, (y + h) // GRID_SIZE + 1):
+                if (col, row) not in self._grid:
+                    self._grid[(col, row)] = set()
+                self._grid[(col, row)].add(spr)
+                cells.append((col, row))
+        self._cells[spr] = cells
+
+    def _remove_from_grid(self, spr):
+        for cell in self._cells.pop(spr, []):
+            self._grid[cell].discard(spr)
+            if len(self._grid[cell]) == 0:
+                del self._grid[cell]
+
+    def update_grid(self, spr):
+        ''' A sprite has moved or changed size '''
+        if spr in self._cells:
+            self._remove_from_grid(spr)
+            self._add_to_grid(spr)
+
+    def defer_inval(self):
+        ''' Collect invalidated regions until flush_inval is called '''
+        if self._damage is None:
+            self._damage = []
+
+    def flush_inval(self):
+        ''' Invalidate the bounding box of the collected regions '''
+        damage = self._damage
+        self._damage = None
+        if not damage:
+            return
+        x = min([rect[0] for rect in damage])
+        y = min([rect[1] for rect in damage])
+        w = max([rect[0] + rect[2] for rect in damage]) - x
+        h = max([rect[1] + rect[3] for rect in damage]) - y
+        self.widget.queue_draw_area(x, y, w, h)
+
+    def inval(self, rect):
+        ''' Invalidate a region for gtk (or save it for later) '''
+        if self._damage is not None:
+            self._damage.append(rect[:])
+        else:
+            self.widget.queue_draw_area(rect[0], rect[1], rect[2], rect[3])
 
     def find_sprite(self, pos):
         ''' Search based on (x, y) position. Return the 'top/first' one. '''
-        list = self.list[:]
-        list.reverse()
-        for spr in list:
+        cell = (int(pos[0]) // GRID_SIZE, int(pos[1]) // GRID_SIZE)
+        found = None
+        for spr in self._grid.get(cell, []):
             if spr.hit(pos):
-                return spr
-        return None
+                if found is None or \
+                   (spr.layer, spr.z) > (found.layer, found.z):
+                    found = spr
+        return found
 
     def redraw_sprites(self, area=None, cr=None):
-        ''' Redraw the sprites that intersect area. '''
+        ''' Redraw the sprites that intersect area, which is either a
+        Gdk.Rectangle or (x, y, width, height). '''
         # I think I need to do this to save Cairo some work
         if cr is None:
             cr = self.cr
@@ -141,13 +230,11 @@ class Sprites:
         if cr is None:
             print('sprites.redraw_sprites: no Cairo context')
             return
-        for spr in self.list:
-            if area is None:
+        if area is not None and hasattr(area, 'width'):
+            area = (area.x, area.y, area.width, area.height)
+        for spr in self._bottom_to_top():
+            if area is None or spr.intersects(area):
                 spr.draw(cr=cr)
-            else:
-                intersection = spr.rect.intersect(area)
-                if intersection.width > 0 or intersection.height > 0:
-                    spr.draw(cr=cr)
 
 
 class Sprite:
@@ -170,7 +257,10 @@ class Sprite:
         self._italic = False
         self._color = None
         self._margins = [0, 0, 0, 0]
+        self._layouts = None  # cached label layouts
+        self._surface = None  # cached (surface, dx, dy) of images + labels
         self.layer = 100
+        self.z = 0  # order within the layer
         self.labels = []
         self.images = []
         self._dx = []  # image offsets
@@ -188,7 +278,9 @@ class Sprite:
         self.images[i] = image
         self._dx[i] = dx
         self._dy[i] = dy
-        if isinstance(self.images[i], GdkPixbuf.Pixbuf):
+        self._layouts = None
+        self._surface = None
+        if isinstance(self.images[i], (GdkPixbuf.Pixbuf, cairo.ImageSurface)):
             w = self.images[i].get_width()
             h = self.images[i].get_height()
         else:
@@ -201,11 +293,13 @@ class Sprite:
                 self.rect[2] = w + dx
             if h + dy > self.rect[3]:
                 self.rect[3] = h + dy
+        self._sprites.update_grid(self)
 
     def move(self, pos):
         ''' Move to new (x, y) position '''
         self.inval()
         self.rect[0], self.rect[1] = int(pos[0]), int(pos[1])
+        self._sprites.update_grid(self)
         self.inval()
 
     def move_relative(self, pos):
@@ -213,6 +307,7 @@ class Sprite:
         self.inval()
         self.rect[0] += int(pos[0])
         self.rect[1] += int(pos[1])
+        self._sprites.update_grid(self)
         self.inval()
 
     def get_xy(self):
@@ -238,11 +333,6 @@ class Sprite:
         self._sprites.remove_from_list(self)
         if layer is not None:
             self.layer = layer
-        for i in range(self._sprites.length_of_list()):
-            if self.layer < self._sprites.get_sprite(i).layer:
-                self._sprites.insert_in_list(self, i)
-                self.inval()
-                return
         self._sprites.append_to_list(self)
         self.inval()
 
@@ -254,11 +344,15 @@ class Sprite:
             self.labels[i] = new_label.replace("\0", " ")
         else:
             self.labels[i] = str(new_label)
+        self._layouts = None
+        self._surface = None
         self.inval()
 
     def set_margins(self, l=0, t=0, r=0, b=0):
         ''' Set the margins for drawing the label '''
         self._margins = [l, t, r, b]
+        self._layouts = None
+        self._surface = None
 
     def _extend_labels_array(self, i):
         ''' Append to the labels attribute list '''
@@ -278,6 +372,8 @@ class Sprite:
     def set_font(self, font):
         ''' Set the font for a label '''
         self._fd = Pango.FontDescription(font)
+        self._layouts = None
+        self._surface = None
 
     def set_label_color(self, rgb):
         ''' Set the font color for a label '''
@@ -292,6 +388,7 @@ class Sprite:
         self._color = (int('0x' + rgb[1:3], 16) / 256.,
                        int('0x' + rgb[3:5], 16) / 256.,
                        int('0x' + rgb[5:7], 16) / 256.)
+        self._surface = None
         return
 
     def set_label_attributes(self, scale, rescale=True, horiz_align="center",
@@ -304,6 +401,8 @@ class Sprite:
         self._vert_align[i] = vert_align
         self._x_pos[i] = x_pos
         self._y_pos[i] = y_pos
+        self._layouts = None
+        self._surface = None
 
     def hide(self):
         ''' Hide a sprite '''
@@ -317,10 +416,7 @@ class Sprite:
     def inval(self):
         ''' Invalidate a region for gtk '''
         # self._sprites.window.invalidate_rect(self.rect, False)
-        self._sprites.widget.queue_draw_area(self.rect[0],
-                                             self.rect[1],
-                                             self.rect[2],
-                                             self.rect[3])
+        self._sprites.inval(self.rect)
 
     def draw(self, cr=None):
         ''' Draw the sprite (and label) '''
@@ -329,20 +425,75 @@ class Sprite:
         if cr is None:
             print('sprite.draw: no Cairo context.')
             return
+        # The images and labels are flattened into one surface, which
+        # is only rebuilt when the sprite changes; drawing is a blit.
+        if self._surface is None:
+            self._surface = self._composite(cr)
+        if self._surface is None:
+            return
+        surface, dx, dy = self._surface
+        cr.set_source_surface(surface, self.rect[0] + dx, self.rect[1] + dy)
+        cr.paint()
+
+    def _composite(self, cr):
+        ''' Render the images and labels into a new surface (or reuse
+        the image, if there is only one) '''
+        if self._layouts is None:
+            self._layouts = self._layout_labels(cr)
+        # A lone surface with no labels needs no flattening (or copying)
+        if len(self.images) == 1 and len(self._layouts) == 0 and \
+           isinstance(self.images[0], cairo.ImageSurface) and \
+           self._dx[0] == 0 and self._dy[0] == 0:
+            return (self.images[0], 0, 0)
+        # Labels may spill outside of the sprite
+        x1, y1 = 0, 0
+        x2, y2 = self.rect[2], self.rect[3]
+        for i in range(len(self.images)):
+            x1, y1 = min(x1, self._dx[i]), min(y1, self._dy[i])
+            x2 = max(x2, self._dx[i] + self.rect[2])
+            y2 = max(y2, self._dy[i] + self.rect[3])
+        for pl, x, y in self._layouts:
+            ink, logical = pl.get_pixel_extents()
+            for r in [ink, logical]:
+                x1, y1 = min(x1, x + r.x), min(y1, y + r.y)
+                x2 = max(x2, x + r.x + r.width)
+                y2 = max(y2, y + r.y + r.height)
+        if x2 - x1 <= 0 or y2 - y1 <= 0:
+            return None
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                     int(x2 - x1), int(y2 - y1))
+        scr = cairo.Context(surface)
+        scr.translate(-x1, -y1)
         for i, img in enumerate(self.images):
-            if isinstance(img, GdkPixbuf.Pixbuf):
-                Gdk.cairo_set_source_pixbuf(cr, img,
-                                            self.rect[0] + self._dx[i],
-                                            self.rect[1] + self._dy[i])
-                cr.rectangle(self.rect[0] + self._dx[i],
-                             self.rect[1] + self._dy[i],
-                             self.rect[2],
-                             self.rect[3])
-                cr.fill()
+            if isinstance(img, (GdkPixbuf.Pixbuf, cairo.ImageSurface)):
+                if isinstance(img, GdkPixbuf.Pixbuf):
+                    Gdk.cairo_set_source_pixbuf(scr, img, self._dx[i],
+                                                self._dy[i])
+                else:
+                    scr.set_source_surface(img, self._dx[i], self._dy[i])
+                scr.rectangle(self._dx[i], self._dy[i],
+                              self.rect[2], self.rect[3])
+                scr.fill()
             else:
                 print('sprite.draw: source not a pixbuf (%s)' % (type(img)))
-        if len(self.labels) > 0:
-            self.draw_label(cr)
+        self._show_labels(scr, 0, 0)
+        return (surface, x1, y1)
+
+    def intersects(self, area):
+        ''' Does the sprite (including any label spilling out of it)
+        overlap the (x, y, width, height) area? '''
+        x, y, w, h = area
+        if self._surface is None:
+            sx, sy, sw, sh = self.rect
+        else:
+            surface, dx, dy = self._surface
+            sx, sy = self.rect[0] + dx, self.rect[1] + dy
+            sw, sh = surface.get_width(), surface.get_height()
+        if sx + sw <= x or sx >= x + w:
+            return False
+        if sy + sh <= y or sy >= y + h:
+            return False
+        return True
 
     def hit(self, pos):
         ''' Is (x, y) on top of the sprite? '''
@@ -359,6 +510,25 @@ class Sprite:
 
     def draw_label(self, cr):
         ''' Draw the label based on its attributes '''
+        # Laying out text is expensive, so the layouts are kept until
+        # the label, its attributes, or the sprite size change.
+        if self._layouts is None:
+            self._layouts = self._layout_labels(cr)
+        self._show_labels(cr, self.rect[0], self.rect[1])
+
+    def _show_labels(self, cr, x0, y0):
+        ''' Render the cached label layouts with the sprite at x0, y0 '''
+        for pl, x, y in self._layouts:
+            cr.save()
+            cr.translate(x0 + x, y0 + y)
+            cr.set_source_rgb(self._color[0], self._color[1], self._color[2])
+            PangoCairo.update_layout(cr, pl)
+            PangoCairo.show_layout(cr, pl)
+            cr.restore()
+
+    def _layout_labels(self, cr):
+        ''' Lay out the labels; positions are relative to the sprite '''
+        layouts = []
         my_width = self.rect[2] - self._margins[0] - self._margins[2]
         if my_width < 0:
             my_width = 0
@@ -383,28 +553,24 @@ class Sprite:
                     pl.set_font_description(self._fd)
                     w = pl.get_size()[0] / Pango.SCALE
             if self._x_pos[i] is not None:
-                x = int(self.rect[0] + self._x_pos[i])
+                x = int(self._x_pos[i])
             elif self._horiz_align[i] == "center":
-                x = int(self.rect[0] + self._margins[0] + (my_width - w) / 2)
+                x = int(self._margins[0] + (my_width - w) / 2)
             elif self._horiz_align[i] == 'left':
-                x = int(self.rect[0] + self._margins[0])
+                x = int(self._margins[0])
             else:  # right
-                x = int(self.rect[0] + self.rect[2] - w - self._margins[2])
+                x = int(self.rect[2] - w - self._margins[2])
             h = pl.get_size()[1] / Pango.SCALE
             if self._y_pos[i] is not None:
-                y = int(self.rect[1] + self._y_pos[i])
+                y = int(self._y_pos[i])
             elif self._vert_align[i] == "middle":
-                y = int(self.rect[1] + self._margins[1] + (my_height - h) / 2)
+                y = int(self._margins[1] + (my_height - h) / 2)
             elif self._vert_align[i] == "top":
-                y = int(self.rect[1] + self._margins[1])
+                y = int(self._margins[1])
             else:  # bottom
-                y = int(self.rect[1] + self.rect[3] - h - self._margins[3])
-            cr.save()
-            cr.translate(x, y)
-            cr.set_source_rgb(self._color[0], self._color[1], self._color[2])
-            PangoCairo.update_layout(cr, pl)
-            PangoCairo.show_layout(cr, pl)
-            cr.restore()
+                y = int(self.rect[3] - h - self._margins[3])
+            layouts.append((pl, x, y))
+        return layouts
 
     def label_width(self, cr=None):
         ''' Calculate the width of a label '''
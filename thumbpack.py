@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011-2013 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import sys
+import json
+import mmap
+
+import cairo
+
+from gi.repository import Gdk
+
+import logging
+_logger = logging.getLogger("portfolio-activity")
+
+# Rewrite the pack once this many bytes are no longer used...
+COMPACT_MIN = 1024 * 1024
+# ...and they are more than this fraction of the file
+COMPACT_RATIO = 0.5
+
+
+def frame_thumbnail(pixbuf, frame=None):
+    ''' Paint a thumbnail, and the frame (if any) over it, into a new
+    cairo.ImageSurface. '''
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, pixbuf.get_width(),
+                                 pixbuf.get_height())
+    cr = cairo.Context(surface)
+    Gdk.cairo_set_source_pixbuf(cr, pixbuf, 0, 0)
+    cr.paint()
+    if frame is not None:
+        Gdk.cairo_set_source_pixbuf(cr, frame, 0, 0)
+        cr.paint()
+    surface.flush()
+    return surface
+
+
+class ThumbnailPack():
+
+    ''' Thumbnails stored as raw premultiplied ARGB32 rows in a single
+    file, with an index of uid -> (offset, width, height, stride). The
+    file is memory-mapped, so a thumbnail is wrapped in a cairo surface
+    without decoding or copying. The frame is painted in before a
+    thumbnail is saved, so the sprite can blit the mapped surface. New
+    thumbnails are appended; the file is compacted by flush() when
+    enough of it is stale. '''
+
+    def __init__(self, directory):
+        self._data_path = os.path.join(directory, 'thumbs.pack')
+        self._index_path = os.path.join(directory, 'thumbs.json')
+        self._index = {}  # 'uid wxh': [stamp, offset, width, height, stride]
+        self._map = None
+        self._dirty = False
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+            if index['byteorder'] == sys.byteorder and \
+               os.path.exists(self._data_path):
+                self._index = index['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+        self._length = 0
+        if os.path.exists(self._data_path):
+            self._length = os.path.getsize(self._data_path)
+        # Drop entries that point past the end of the file (e.g., if
+        # we were stopped while appending)
+        for key in list(self._index.keys()):
+            stamp, offset, width, height, stride = self._index[key]
+            if offset + stride * height > self._length:
+                del self._index[key]
+
+    def _key(self, uid, width, height):
+        return '%s %dx%d' % (uid, width, height)
+
+    def lookup(self, uid, stamp, width, height):
+        ''' Return a cairo.ImageSurface backed by the pack, or None '''
+        entry = self._index.get(self._key(uid, width, height))
+        if entry is None or entry[0] != repr(stamp):
+            return None
+        stamp, offset, width, height, stride = entry
+        if self._map is None:
+            try:
+                with open(self._data_path, 'rb') as f:
+                    # A private mapping, as cairo wants a writable buffer
+                    self._map = mmap.mmap(f.fileno(), 0,
+                                          access=mmap.ACCESS_COPY)
+            except (OSError, ValueError) as e:
+                _logger.debug('could not map thumbnails: %s' % (e))
+                return None
+        data = memoryview(self._map)[offset:offset + stride * height]
+        return cairo.ImageSurface.create_for_data(
+            data, cairo.FORMAT_ARGB32, width, height, stride)
+
+    def add(self, uid, stamp, pixbuf, frame=None):
+        ''' Append a thumbnail, with the frame (if any) painted over
+        it; return it as a cairo.ImageSurface '''
+        width = pixbuf.get_width()
+        height = pixbuf.get_height()
+        surface = frame_thumbnail(pixbuf, frame)
+        try:
+            with open(self._data_path, 'ab') as f:
+                f.write(surface.get_data())
+        except OSError as e:
+            _logger.debug('could not save thumbnail: %s' % (e))
+            return surface
+        stride = surface.get_stride()
+        self._index[self._key(uid, width, height)] = [
+            repr(stamp), self._length, width, height, stride]
+        self._length += stride * height
+        self._map = None  # Map again to see the new thumbnail
+        self._dirty = True
+        return surface
+
+    def flush(self, keep=None):
+        ''' Save the index, forgetting thumbnails for uids not in keep,
+        and compact the file if much of it is stale. '''
+        if keep is not None:
+            for key in list(self._index.keys()):
+                if key.split(' ')[0] not in keep:
+                    del self._index[key]
+                    self._dirty = True
+        if not self._dirty:
+            return
+        used = sum([entry[4] * entry[3] for entry in self._index.values()])
+        if self._length - used > COMPACT_MIN and \
+           self._length - used > self._length * COMPACT_RATIO:
+            self._compact()
+        try:
+            with open(self._index_path, 'w') as f:
+                json.dump({'byteorder': sys.byteorder,
+                           'entries': self._index}, f)
+            self._dirty = False
+        except OSError as e:
+            _logger.debug('could not save thumbnail index: %s' % (e))
+
+    def _compact(self):
+        ''' Rewrite the file with just the thumbnails still in use.
+        Surfaces handed out earlier keep the old mapping. '''
+        tmp_path = self._data_path + '.tmp'
+        offset = 0
+        try:
+            with open(self._data_path, 'rb') as old, \
+                    open(tmp_path, 'wb') as new:
+                for entry in self._index.values():
+                    size = entry[4] * entry[3]
+                    old.seek(entry[1])
+                    new.write(old.read(size))
+                    entry[1] = offset
+                    offset += size
+            os.replace(tmp_path, self._data_path)
+        except OSError as e:
+            _logger.debug('could not compact thumbnails: %s' % (e))
+            self._index = {}
+            offset = 0
+            if os.path.exists(self._data_path):
+                os.remove(self._data_path)
+        self._length = offset
+        self._map = None
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011-2013 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import hashlib
+import tempfile
+from threading import Lock
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+import logging
+_logger = logging.getLogger("portfolio-activity")
+
+DEFAULT_BUDGET = 64 * 1024 * 1024  # bytes on disk
+
+
+class ThumbnailStore():
+
+    ''' Scaled previews saved as PNG files, keyed by Journal object id,
+    the object's timestamp, and size. When the files grow past the
+    budget, the least recently used ones are removed. It is safe to use
+    from more than one thread. '''
+
+    def __init__(self, directory, budget=DEFAULT_BUDGET):
+        self._directory = directory
+        self._budget = budget
+        self._lock = Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._size = 0
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.png'):
+                self._size += entry.stat().st_size
+
+    def _path(self, uid, stamp, width, height):
+        key = '%s %r %dx%d' % (uid, stamp, width, height)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, name + '.png')
+
+    def contains(self, uid, stamp, width, height):
+        ''' Is there a stored pixbuf? '''
+        return os.path.exists(self._path(uid, stamp, width, height))
+
+    def lookup(self, uid, stamp, width, height):
+        ''' Return the stored pixbuf or None '''
+        path = self._path(uid, stamp, width, height)
+        if not os.path.exists(path):
+            return None
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+            os.utime(path)  # Recently used
+            return pixbuf
+        except (GLib.Error, OSError) as e:
+            _logger.debug('could not load thumbnail %s: %s' % (path, e))
+            # Remove it, so that contains() no longer claims it
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def store(self, uid, stamp, width, height, pixbuf):
+        ''' Save a pixbuf, making room for it if need be '''
+        path = self._path(uid, stamp, width, height)
+        # Write to a temporary file first, so that a crash cannot leave
+        # half a PNG under the real name
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                            dir=self._directory)
+            os.close(fd)
+            pixbuf.savev(tmp_path, 'png', [], [])
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except (GLib.Error, OSError) as e:
+            _logger.debug('could not save thumbnail %s: %s' % (path, e))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self._size += size
+            if self._size > self._budget:
+                self._trim()
+
+    def _trim(self):
+        ''' Remove the least recently used files until we are well
+        under budget '''
+        entries = [entry for entry in os.scandir(self._directory)
+                   if entry.name.endswith('.png')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self._size = sum([entry.stat().st_size for entry in entries])
+        for entry in entries:
+            if self._size <= self._budget * 0.8:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._size -= size
+            except OSError:
+                pass
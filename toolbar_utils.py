@@ -15,6 +15,7 @@ from gi.repository import Gtk
 
 from sugar3.graphics.radiotoolbutton import RadioToolButton
 from sugar3.graphics.toolbutton import ToolButton
+from sugar3.graphics.toggletoolbutton import ToggleToolButton
 from sugar3.graphics.combobox import ComboBox
 
 
@@ -102,6 +103,25 @@ def radio_factory(button_name, toolbar, callback, cb_arg=None, tooltip=None,
     return button
 
 
+def toggle_factory(icon_name, toolbar, callback, cb_arg=None, tooltip=None,
+                   active=False):
+    ''' Add a toggle button to a toolbar '''
+    button = ToggleToolButton(icon_name)
+    button.set_active(active)
+    if cb_arg is not None:
+        button.connect('toggled', callback, cb_arg)
+    else:
+        button.connect('toggled', callback)
+    if hasattr(toolbar, 'insert'):  # the main toolbar
+        toolbar.insert(button, -1)
+    else:  # or a secondary toolbar
+        toolbar.props.page.insert(button, -1)
+    button.show()
+    if tooltip is not None:
+        button.set_tooltip(tooltip)
+    return button
+
+
 def label_factory(toolbar, label_text, width=None):
     ''' Factory for adding a label to a toolbar '''
     label = Gtk.Label(label=label_text)
@@ -11,9 +11,12 @@
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
 
+from gi.repository import Gdk
 from gi.repository import GdkPixbuf
+import cairo
 import os
 import subprocess
+from collections import OrderedDict
 
 XO1 = 'xo1'
 XO15 = 'xo1.5'
@@ -21,6 +24,13 @@ XO175 = 'xo1.75'
 XO4 = 'xo4'
 UNKNOWN = 'unknown'
 
+# Kinds of window chrome rendered by chrome_pixbuf
+BLANK = 'blank'  # a filled rectangle, as in genblank
+FRAME = 'frame'  # a two-color frame, as in svg_rectangle
+
+CHROME_CACHE_SIZE = 32
+_chrome_cache = OrderedDict()
+
 
 def get_tablet_mode():
     if not os.path.exists('/dev/input/event4'):
@@ -164,6 +174,37 @@ stroke-dasharray:none" />\
            width - 15, height - 15, colors[0])
 
 
+def chrome_pixbuf(kind, width, height, colors, stroke_width=1.0):
+    ''' Return a pixbuf for a blank rectangle or a frame. The pixbufs
+    are shared between callers, so they must not be modified. '''
+    key = (kind, int(width), int(height), tuple(colors), stroke_width)
+    if key in _chrome_cache:
+        _chrome_cache.move_to_end(key)
+        return _chrome_cache[key]
+    if kind == BLANK:
+        pixbuf = _draw_blank(int(width), int(height), colors, stroke_width)
+    else:
+        pixbuf = svg_str_to_pixbuf(svg_rectangle(int(width), int(height),
+                                                 colors))
+    _chrome_cache[key] = pixbuf
+    if len(_chrome_cache) > CHROME_CACHE_SIZE:
+        _chrome_cache.popitem(last=False)
+    return pixbuf
+
+
+def _draw_blank(width, height, colors, stroke_width):
+    ''' Draw what genblank describes with cairo, skipping the SVG. '''
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    cr = cairo.Context(surface)
+    cr.rectangle(0.25, 0.25, width - 0.5, height - 0.5)
+    cr.set_source_rgb(*rgb(colors[1]))
+    cr.fill_preserve()
+    cr.set_line_width(stroke_width)
+    cr.set_source_rgb(*rgb(colors[0]))
+    cr.stroke()
+    return Gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
+
+
 def load_svg_from_file(file_path, width, height):
     '''Create a pixbuf from SVG in a file. '''
     return GdkPixbuf.Pixbuf.new_from_file_at_size(file_path, width, height)